@@ -1,4 +1,12 @@
-from .merge import merge_fn, merge_samples
-from .vocab import Vocab, restore_text
-from .reader import Reader
+from .merge import (merge_fn, merge_samples, pack_fn, Packer, packed_attention_mask,
+                    ragged_to_padded, ragged_to_packed)
+from .vocab import Vocab, BinaryVocab, restore_text, build_vocab
+from .reader import Reader, ShardedReader
 from .dataset import *
+from .tokenized import TokenizedDataset, build_tokenized
+from .cache import LRUCache, SharedCache
+from .columnar import ColumnStore
+from .sampler import (ResumableRandomSampler, BucketBatchSampler,
+                      ClassBalancedSampler, dataset_lengths,
+                      padding_ratio)
+from .preprocess import PreprocessedDataset, preprocess
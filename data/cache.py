@@ -0,0 +1,427 @@
+from collections import OrderedDict
+from hashlib import blake2b, sha1
+from multiprocessing import Lock
+from os import path, makedirs, replace, stat, getpid
+import json
+import mmap
+import pickle
+import struct
+import sys
+import types
+import numpy as np
+import torch
+from .reader import MADVISE
+
+
+def sample_nbytes(obj):
+    '''Return approximate memory size of a sample in bytes'''
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(sample_nbytes(k) + sample_nbytes(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sum(sample_nbytes(v) for v in obj)
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    return sys.getsizeof(obj)
+
+
+class LRUCache(object):
+    '''
+    Dict-like cache evicting least recently used items.
+
+    Without limits it behaves as a plain dict with hit/miss counters.
+    '''
+
+    def __init__(self, max_items=None, max_bytes=None, sizeof=sample_nbytes):
+        '''
+        max_items (int or None): maximum number of items
+        max_bytes (int or None): maximum total size of items given by sizeof
+        sizeof (function(value)): size of an item in bytes
+        '''
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.data = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self.data:
+            self.pop(key)
+        if self.max_bytes is not None:
+            size = self.sizeof(value)
+            if size > self.max_bytes:
+                return
+            self.sizes[key] = size
+            self.nbytes += size
+        self.data[key] = value
+
+        while self.max_items is not None and len(self.data) > self.max_items:
+            self.pop(next(iter(self.data)))
+        while self.max_bytes is not None and self.nbytes > self.max_bytes:
+            self.pop(next(iter(self.data)))
+
+    def pop(self, key):
+        value = self.data.pop(key)
+        self.nbytes -= self.sizes.pop(key, 0)
+        return value
+
+    def clear(self):
+        self.data.clear()
+        self.sizes.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'items': len(self.data),
+            'bytes': self.nbytes,
+        }
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __len__(self):
+        return len(self.data)
+
+
+# slot header: tag (key hash + 1, 0 means empty), payload length
+_HEADER = struct.Struct('<qq')
+
+
+def _key_hash(key):
+    '''Return a non negative 62 bit hash of key, stable across processes'''
+    if isinstance(key, int) and 0 <= key < (1 << 62):
+        return key
+    if isinstance(key, str):
+        data = key.encode('utf-8')
+    elif isinstance(key, bytes):
+        data = key
+    else:
+        data = pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL)
+    return int.from_bytes(blake2b(data, digest_size=8).digest(), 'little') >> 2
+
+
+class SharedCache(object):
+    '''
+    Fixed size cache in anonymous shared memory.
+
+    Create it before DataLoader workers are forked: every worker then reads
+    and writes the same memory, so the dataset is cached once instead of once
+    per worker. Each key maps to one slot (key hash % capacity) and a new item
+    overwrites the previous one in its slot. Items are pickled; an item larger
+    than slot_bytes is not cached. Only works with the fork start method.
+    '''
+
+    def __init__(self, capacity, slot_bytes):
+        '''
+        capacity (int): number of slots
+        slot_bytes (int): maximum pickled size of an item
+        '''
+        assert capacity > 0 and slot_bytes > 0
+        self.capacity = capacity
+        self.slot_bytes = slot_bytes
+        self.stride = _HEADER.size + slot_bytes
+        self.mm = mmap.mmap(-1, capacity * self.stride)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _slot(self, key):
+        h = _key_hash(key)
+        return (h % self.capacity) * self.stride, h + 1
+
+    def get(self, key, default=None):
+        pos, tag = self._slot(key)
+        stored, length = _HEADER.unpack_from(self.mm, pos)
+        if stored == tag:
+            start = pos + _HEADER.size
+            payload = self.mm[start:start + length]
+            # the slot may have been overwritten while reading it
+            if _HEADER.unpack_from(self.mm, pos)[0] == tag:
+                try:
+                    stored_key, value = pickle.loads(payload)
+                except Exception:
+                    stored_key = value = None
+                if stored_key == key:
+                    self.hits += 1
+                    return value
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        payload = pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.slot_bytes:
+            return
+        pos, tag = self._slot(key)
+        start = pos + _HEADER.size
+        with self.lock:
+            _HEADER.pack_into(self.mm, pos, 0, 0)
+            self.mm[start:start + len(payload)] = payload
+            _HEADER.pack_into(self.mm, pos, tag, len(payload))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def __contains__(self, key):
+        pos, tag = self._slot(key)
+        return _HEADER.unpack_from(self.mm, pos)[0] == tag
+
+    def __getitem__(self, key):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+
+def _code_digest(code):
+    h = sha1(code.co_code)
+    h.update(repr(code.co_names).encode('utf-8'))
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            h.update(_code_digest(c).encode('utf-8'))
+        else:
+            h.update(repr(c).encode('utf-8'))
+    return h.hexdigest()
+
+
+def describe(obj, _seen=None):
+    '''
+    Return a json-serializable description of obj used to fingerprint
+    transformer configurations. Objects are described by their class and
+    attributes except the names in their `_volatile`, functions by their
+    name, code and closure.
+    '''
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, bytes):
+        return sha1(obj).hexdigest()
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            # the bytes of an object array are pointers
+            return [str(obj.dtype), obj.shape, describe(obj.tolist(), _seen)]
+        return [str(obj.dtype), obj.shape, sha1(obj.tobytes()).hexdigest()]
+    if isinstance(obj, torch.Tensor):
+        return describe(obj.detach().cpu().numpy(), _seen)
+    if isinstance(obj, type):
+        return '%s.%s' % (obj.__module__, obj.__qualname__)
+
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return '<cycle>'
+    _seen = _seen | {id(obj)}
+
+    if isinstance(obj, (list, tuple)):
+        return [describe(v, _seen) for v in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted((describe(v, _seen) for v in obj), key=repr)
+    if isinstance(obj, dict):
+        return sorted([[describe(k, _seen), describe(v, _seen)]
+                       for k, v in obj.items()], key=repr)
+    if isinstance(obj, types.FunctionType):
+        cells = obj.__closure__ or ()
+        return {
+            'function': '%s.%s' % (obj.__module__, obj.__qualname__),
+            'code': _code_digest(obj.__code__),
+            'defaults': describe(obj.__defaults__, _seen),
+            'closure': [describe(c.cell_contents, _seen) for c in cells],
+        }
+    if isinstance(obj, types.MethodType):
+        return {
+            'method': describe(obj.__func__, _seen),
+            'self': describe(obj.__self__, _seen),
+        }
+    if isinstance(obj, types.BuiltinFunctionType):
+        return '%s.%s' % (obj.__module__, obj.__qualname__)
+    if hasattr(obj, '__dict__'):
+        # attributes not changing the output (e.x. caches and counters)
+        volatile = getattr(obj, '_volatile', ())
+        attrs = {k: v for k, v in vars(obj).items() if k not in volatile}
+        return {
+            'class': describe(type(obj)),
+            'vars': describe(attrs, _seen),
+        }
+    return repr(obj)
+
+
+def fingerprint(*objs):
+    '''Return a hex digest of the descriptions of objs'''
+    desc = json.dumps(describe(list(objs)), sort_keys=True, default=str)
+    return sha1(desc.encode('utf-8')).hexdigest()
+
+
+def file_fingerprint(file, digest=False):
+    '''
+    Return (absolute path, size, mtime) of file.
+
+    digest (bool): use a hash of the contents instead of mtime
+    '''
+    st = stat(file)
+    if not digest:
+        return [path.abspath(file), st.st_size, st.st_mtime_ns]
+    h = sha1()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b''):
+            h.update(chunk)
+    return [path.abspath(file), st.st_size, h.hexdigest()]
+
+
+class DiskCache(object):
+    '''
+    Transformed samples stored on disk.
+
+    Samples are pickled back to back in `<cache_dir>/<key>.bin` with their
+    offsets (npy) in `<key>.bin.idx`, and read back through a read-only
+    mmap. The index is written last, so an interrupted write is never used.
+    The offsets are only ever loaded, never rebuilt from the data file, so
+    copies with new mtimes stay readable.
+    '''
+
+    def __init__(self, cache_dir, key):
+        self.cache_dir = cache_dir
+        self.key = key
+        self.data_file = path.join(cache_dir, key + '.bin')
+        self.idx_file = self.data_file + '.idx'
+        self.idx = None
+        self.mm = None
+        self._pid = None
+
+    def exists(self):
+        return path.isfile(self.data_file) and path.isfile(self.idx_file)
+
+    def write(self, samples):
+        '''
+        samples (iterable): samples in dataset order
+        '''
+        if not path.isdir(self.cache_dir):
+            makedirs(self.cache_dir)
+        tmp = self.data_file + '.tmp'
+        offsets = [0]
+        with open(tmp, 'wb') as f:
+            for sample in samples:
+                f.write(pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL))
+                offsets.append(f.tell())
+        with open(self.idx_file + '.tmp', 'wb') as f:
+            np.save(f, np.asarray(offsets, dtype=np.int64))
+        replace(tmp, self.data_file)
+        replace(self.idx_file + '.tmp', self.idx_file)
+
+    def open(self):
+        self.idx = np.load(self.idx_file, 'r')
+        size = int(self.idx[-1])
+        if size != path.getsize(self.data_file):
+            raise ValueError('%s does not match its index %s' %
+                             (self.data_file, self.idx_file))
+        if size == 0:
+            self.mm = b''
+        else:
+            with open(self.data_file, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self.mm, 'madvise'):
+                self.mm.madvise(getattr(mmap, MADVISE['random'], 0))
+        self._pid = getpid()
+        return self
+
+    def raw(self, idx):
+        '''Return the stored bytes of sample idx'''
+        if self._pid != getpid():
+            self.open()
+        if idx < 0:
+            idx += len(self)
+        start, end = int(self.idx[idx]), int(self.idx[idx + 1])
+        return self.mm[start:end]
+
+    def __getitem__(self, idx):
+        return pickle.loads(self.raw(idx))
+
+    def __len__(self):
+        if self._pid != getpid():
+            self.open()
+        return len(self.idx) - 1
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['idx'] = state['mm'] = state['_pid'] = None
+        return state
+
+
+if __name__ == '__main__':
+    # persist() round trip: a second process must reuse the cache written by
+    # the first, also after the cache files got new mtimes (e.x. a copy)
+    import os
+    import subprocess
+    import tempfile
+
+    if len(sys.argv) > 1:
+        from .dataset import LineDataset
+        from .transformer import ClipText, Text2Id, Token2Id, Tokenizer
+        from .vocab import BinaryVocab, Vocab
+
+        work = sys.argv[1]
+        vocab = Vocab(path.join(work, 'vocab.txt'), 0)
+        vocab.save_binary(path.join(work, 'vocab.bin'))
+        binary = BinaryVocab(path.join(work, 'vocab.bin'))
+        for convert in [Text2Id(vocab, 'text'),
+                        Token2Id(binary.word2id, 'text')]:
+            ds = LineDataset('text',
+                             path.join(work, 'data.txt'),
+                             transformer=[
+                                 Tokenizer(str.split, 'text'),
+                                 convert,
+                                 ClipText(4, 'text'),
+                             ],
+                             save_trans=False)
+            ds.persist(path.join(work, 'cache'))
+            print(ds.disk_cache.key, [ds[i] for i in range(len(ds))])
+        sys.exit()
+
+    work = tempfile.mkdtemp()
+    with open(path.join(work, 'vocab.txt'), 'w') as f:
+        f.write('a 5\nb 4\nc 3\n')
+    with open(path.join(work, 'data.txt'), 'w') as f:
+        for i in range(100):
+            f.write(' '.join('abcd'[j % 4] for j in range(i % 7)) + '\n')
+
+    def child():
+        cmd = [sys.executable, '-m', 'data.cache', work]
+        root = path.dirname(path.dirname(path.abspath(__file__)))
+        return subprocess.check_output(cmd, cwd=root).decode('utf-8')
+
+    first = child()
+    cache_dir = path.join(work, 'cache')
+    files = sorted(os.listdir(cache_dir))
+    for f in files:
+        os.utime(path.join(cache_dir, f))
+    os.utime(path.join(cache_dir, files[0]), (1e10, 1e10))
+    second = child()
+    keys = [line.split()[0] for line in (first + second).splitlines()]
+    assert first == second, 'caches not reused: %s' % keys
+    assert sorted(os.listdir(cache_dir)) == files, files
+    print('persist round trip ok: %s' % first.split()[0])
@@ -0,0 +1,143 @@
+from array import array
+from os import path, makedirs, remove, replace
+import json
+import numpy as np
+from .cache import DiskCache, file_fingerprint
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def _is_int(v):
+    return isinstance(v, int) and not isinstance(v, bool)
+
+
+class ColumnStore(object):
+    '''
+    Columnar copy of some fields of a json line file.
+
+    Fields holding only ints or only floats are stored as npy arrays; other
+    fields as json encoded values in `<field>.bin` with their offsets in
+    `<field>.bin.idx`, read as a DiskCache (never re-indexed by newlines).
+    `columns.json` records the source files, so a changed source is
+    converted again.
+    '''
+
+    def __init__(self, out_dir, reader, fields):
+        '''
+        out_dir (str): directory of the column files
+        reader (Reader or ShardedReader): the json line file
+        fields (list[str])
+        '''
+        self.out_dir = out_dir
+        self.fields = list(fields)
+        self.meta_file = path.join(out_dir, 'columns.json')
+
+        source = self.fingerprint(reader)
+        if not self.valid(source):
+            self.build(reader, source)
+        with open(self.meta_file) as f:
+            self.meta = json.load(f)
+        self._columns = None
+
+    @staticmethod
+    def fingerprint(reader):
+        files = getattr(reader, 'data_files', None) or [reader.data_file]
+        return [file_fingerprint(f) for f in files]
+
+    def valid(self, source):
+        if not path.isfile(self.meta_file):
+            return False
+        with open(self.meta_file) as f:
+            meta = json.load(f)
+        return meta['source'] == source and set(self.fields) <= set(
+            meta['kinds'])
+
+    def column_file(self, field, ext):
+        return path.join(self.out_dir, '%s.%s' % (field, ext))
+
+    def build(self, reader, source):
+        if not path.isdir(self.out_dir):
+            makedirs(self.out_dir)
+        bins = {k: open(self.column_file(k, 'bin.tmp'), 'wb') for k in self.fields}
+        offsets = {k: array('q', [0]) for k in self.fields}
+        ints = {k: array('q') for k in self.fields}
+        floats = {k: array('d') for k in self.fields}
+        try:
+            for i in range(len(reader)):
+                record = json_loads(reader.get(i, decode=False))
+                for k in self.fields:
+                    v = record[k]
+                    bins[k].write(json_dumps(v))
+                    offsets[k].append(bins[k].tell())
+                    if ints[k] is not None:
+                        if _is_int(v) and -(1 << 63) <= v < (1 << 63):
+                            ints[k].append(v)
+                        else:
+                            ints[k] = None
+                    if floats[k] is not None:
+                        if isinstance(v, float):
+                            floats[k].append(v)
+                        else:
+                            floats[k] = None
+        finally:
+            for f in bins.values():
+                f.close()
+
+        kinds = {}
+        for k in self.fields:
+            if ints[k] is not None or floats[k] is not None:
+                values = ints[k] if ints[k] is not None else floats[k]
+                kinds[k] = 'int' if ints[k] is not None else 'float'
+                with open(self.column_file(k, 'npy'), 'wb') as f:
+                    np.save(f, np.frombuffer(values, dtype=values.typecode))
+                remove(self.column_file(k, 'bin.tmp'))
+            else:
+                kinds[k] = 'json'
+                replace(self.column_file(k, 'bin.tmp'), self.column_file(k, 'bin'))
+                with open(self.column_file(k, 'bin.idx'), 'wb') as f:
+                    np.save(f, np.frombuffer(offsets[k], dtype=np.int64))
+
+        meta = {'source': source, 'kinds': kinds, 'num_samples': len(reader)}
+        with open(self.meta_file + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        replace(self.meta_file + '.tmp', self.meta_file)
+
+    def _load(self):
+        self._columns = {}
+        for k in self.fields:
+            if self.meta['kinds'][k] == 'json':
+                self._columns[k] = DiskCache(self.out_dir, k).open()
+            else:
+                self._columns[k] = np.load(self.column_file(k, 'npy'), 'r')
+
+    def __getitem__(self, idx):
+        if self._columns is None:
+            self._load()
+        sample = {}
+        for k in self.fields:
+            column = self._columns[k]
+            if isinstance(column, DiskCache):
+                sample[k] = json_loads(column.raw(idx))
+            else:
+                sample[k] = column[idx].item()
+        return sample
+
+    def __len__(self):
+        return self.meta['num_samples']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_columns'] = None
+        return state
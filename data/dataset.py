@@ -1,54 +1,171 @@
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+import torch.distributed as dist
 from os import path
-from .reader import Reader
-import json
+import random
+from .reader import Reader, ShardedReader
+from .cache import LRUCache, DiskCache, describe, fingerprint, file_fingerprint
+from .columnar import ColumnStore, json_loads
 from abc import abstractmethod
-from collections import Counter
+import numpy as np
+
+
+def apply_transformer(transformer, sample):
+    '''apply a transformer or a list of transformers to sample'''
+    if transformer:
+        if isinstance(transformer, list):
+            for c in transformer:
+                sample = c(sample)
+        else:
+            sample = transformer(sample)
+    return sample
+
+
+def apply_transformer_many(transformer, samples):
+    '''
+    apply a transformer or a list of transformers to a list of samples.
+    transformers with a `batch` method process the whole list at once.
+    '''
+    if not transformer:
+        return samples
+    transformers = transformer if isinstance(transformer, list) else [transformer]
+    for c in transformers:
+        if hasattr(c, 'batch'):
+            samples = c.batch(samples)
+        else:
+            samples = [c(s) for s in samples]
+    return samples
 
 
 class BaseDataset(Dataset):
-    def __init__(self, transformer=None, save_trans=True):
+    def __init__(self, transformer=None, save_trans=True, cache=None):
+        '''
+        transformer (callable or list[callable])
+        save_trans (bool): keep transformed samples in an unbounded LRUCache
+        cache (LRUCache, SharedCache or None): cache of transformed samples.
+            overrides save_trans
+        '''
         self.data = None
 
         self.transformer = transformer
-        self.transformed = {}
-        self.save_trans = save_trans
+        if cache is None and save_trans:
+            cache = LRUCache()
+        self.transformed = cache
+        self.save_trans = cache is not None
+        self.disk_cache = None
 
     def __len__(self):
         return len(self.data)
 
     def transform(self, sample):
-        if self.transformer:
-            if isinstance(self.transformer, list):
-                for c in self.transformer:
-                    sample = c(sample)
-            else:
-                sample = self.transformer(sample)
-        return sample
+        return apply_transformer(self.transformer, sample)
 
     @abstractmethod
     def prepare(self, idx):
         pass
 
-    def __getitem__(self, idx):
-        if self.save_trans and idx in self.transformed:
-            return self.transformed[idx]
+    def prepare_many(self, indices):
+        return [self.prepare(idx) for idx in indices]
 
-        sample = self.prepare(idx)
+    def transform_many(self, samples):
+        return apply_transformer_many(self.transformer, samples)
 
-        sample = self.transform(sample)
+    def source_fingerprint(self, digest=False):
+        '''Return a description of the source data, used by persist'''
+        raise NotImplementedError(
+            '%s does not support persist' % type(self).__name__)
+
+    def cache_config(self):
+        '''Return the attributes which change the output of prepare'''
+        skip = {'data', 'file', 'transformer', 'transformed', 'save_trans',
+                'disk_cache', 'columns'}
+        return {k: v for k, v in vars(self).items() if k not in skip}
+
+    def persist(self, cache_dir, digest=False):
+        '''
+        Store all transformed samples under cache_dir, or reuse the ones
+        stored by a previous run. The cache is keyed by the source data, the
+        dataset configuration and the transformer, so changing any of them
+        writes a new cache.
+
+        cache_dir (str)
+        digest (bool): fingerprint source files by content instead of mtime
+        '''
+        key = fingerprint(type(self), self.source_fingerprint(digest),
+                          self.cache_config(), self.transformer)
+        cache = DiskCache(cache_dir, key)
+        if not cache.exists():
+            cache.write(
+                self.transform(self.prepare(i)) for i in range(len(self)))
+        self.disk_cache = cache.open()
+        return self
+
+    def __getitem__(self, idx):
+        if self.save_trans:
+            sample = self.transformed.get(idx)
+            if sample is not None:
+                return sample
+
+        if self.disk_cache is not None:
+            sample = self.disk_cache[idx]
+        else:
+            sample = self.prepare(idx)
+            sample = self.transform(sample)
         if self.save_trans:
             self.transformed[idx] = sample
 
         return sample
 
+    def __getitems__(self, indices):
+        '''
+        Return the samples of indices. Used by DataLoader to fetch a whole
+        batch with one bulk read and batch-aware transformers.
+        '''
+        samples = [None] * len(indices)
+        missing = []
+        for j, idx in enumerate(indices):
+            if self.save_trans:
+                samples[j] = self.transformed.get(idx)
+            if samples[j] is None:
+                missing.append(j)
+        if len(missing) == 0:
+            return samples
+
+        idxs = [indices[j] for j in missing]
+        if self.disk_cache is not None:
+            fetched = [self.disk_cache[idx] for idx in idxs]
+        else:
+            fetched = self.transform_many(self.prepare_many(idxs))
+        for j, idx, sample in zip(missing, idxs, fetched):
+            samples[j] = sample
+            if self.save_trans:
+                self.transformed[idx] = sample
+        return samples
+
 
 class FileDataset(BaseDataset):
     def __init__(self, file, *args, **keys):
+        '''
+        file (str, list[str], Reader or ShardedReader): a line file, shards of
+            line files or an opened reader
+        '''
         super(FileDataset, self).__init__(*args, **keys)
-        assert path.isfile(file), file
         self.file = file
-        self.data = Reader(self.file)
+        if isinstance(file, (Reader, ShardedReader)):
+            self.data = file
+        elif isinstance(file, (list, tuple)):
+            for f in file:
+                assert path.isfile(f), f
+            self.data = ShardedReader(file)
+        else:
+            assert path.isfile(file), file
+            self.data = Reader(self.file)
+
+    def source_fingerprint(self, digest=False):
+        if isinstance(self.data, ShardedReader):
+            files = self.data.data_files
+        else:
+            files = [self.data.data_file]
+        return [file_fingerprint(f, digest) for f in files]
 
 
 class LineDataset(FileDataset):
@@ -61,13 +178,47 @@ class LineDataset(FileDataset):
         sample[self.key] = self.data[idx]
         return sample
 
+    def prepare_many(self, indices):
+        return [{self.key: line} for line in self.data.get_many(indices)]
+
 
 class JsonLineDataset(FileDataset):
-    def __init__(self, *args, **keys):
+    '''
+    Each line is parsed from the raw bytes with orjson if it is installed,
+    otherwise with json.
+    '''
+
+    def __init__(self, *args, fields=None, columns=None, **keys):
+        '''
+        fields (list[str] or None): keys kept from each record. None keeps all
+        columns (str or None): directory of a columnar copy of fields. it is
+            built on first use and read instead of the json lines.
+        '''
         super(JsonLineDataset, self).__init__(*args, **keys)
+        self.fields = list(fields) if fields is not None else None
+        self.columns = None
+        if columns is not None:
+            assert self.fields, 'columns requires fields'
+            self.columns = ColumnStore(columns, self.data, self.fields)
 
     def prepare(self, idx):
-        return json.loads(self.data[idx])
+        if self.columns is not None:
+            return self.columns[idx]
+        record = json_loads(self.data.get(idx, decode=False))
+        if self.fields is None:
+            return record
+        return {k: record[k] for k in self.fields}
+
+    def prepare_many(self, indices):
+        if self.columns is not None:
+            return [self.columns[idx] for idx in indices]
+        records = [
+            json_loads(line)
+            for line in self.data.get_many(indices, decode=False)
+        ]
+        if self.fields is None:
+            return records
+        return [{k: r[k] for k in self.fields} for r in records]
 
 
 class ListDataset(BaseDataset):
@@ -75,18 +226,186 @@ class ListDataset(BaseDataset):
         super(ListDataset, self).__init__(*args, **keys)
         self.data = data
 
+    def source_fingerprint(self, digest=False):
+        return describe(self.data)
+
     def prepare(self, idx):
         return self.data[idx]
 
 
+def iter_lines(file, start, end, chunk_size=1 << 22):
+    '''
+    Yield the lines (bytes, with newline) of file starting in [start, end).
+    The file is read sequentially in chunks of chunk_size bytes.
+    '''
+    with open(file, 'rb') as f:
+        if start > 0:
+            # skip the line started before `start`; it belongs to the previous range
+            f.seek(start - 1)
+            start += len(f.readline()) - 1
+        pos = start
+        rest = b''
+        while pos < end:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                if pos >= end:
+                    return
+                pos += len(line) + 1
+                yield line + b'\n'
+        if rest and pos < end:
+            yield rest
+
+
+def shuffle_buffer(iterable, size, rng):
+    '''Approximately shuffle iterable keeping at most size items in memory'''
+    buf = []
+    for x in iterable:
+        if len(buf) < size:
+            buf.append(x)
+            continue
+        j = rng.randrange(size)
+        yield buf[j]
+        buf[j] = x
+    rng.shuffle(buf)
+    for x in buf:
+        yield x
+
+
+class StreamDataset(IterableDataset):
+    '''
+    Iterate over line files with large sequential reads and no index.
+
+    The bytes of all files are split into equal ranges, one for every
+    DataLoader worker of every rank, so each line is read exactly once per
+    epoch. With shuffle_buffer > 0 samples are shuffled approximately through
+    a buffer of that size; call set_epoch to change the order every epoch.
+    '''
+
+    def __init__(self,
+                 file,
+                 transformer=None,
+                 shuffle_buffer=0,
+                 seed=0,
+                 chunk_size=1 << 22,
+                 rank=None,
+                 world_size=None):
+        '''
+        file (str or list[str]): a line file or shards of line files
+        transformer (callable or list[callable])
+        shuffle_buffer (int): size of the shuffle buffer. 0 disables shuffling
+        seed (int)
+        chunk_size (int): bytes per read
+        rank, world_size (int or None): default to torch.distributed's if it
+            is initialized, otherwise to 0 and 1
+        '''
+        self.files = list(file) if isinstance(file, (list, tuple)) else [file]
+        for f in self.files:
+            assert path.isfile(f), f
+        self.transformer = transformer
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.chunk_size = chunk_size
+        self.rank = rank
+        self.world_size = world_size
+
+    @abstractmethod
+    def prepare(self, line):
+        '''convert a line (bytes) to a sample'''
+        pass
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def transform(self, sample):
+        return apply_transformer(self.transformer, sample)
+
+    def part(self):
+        '''Return (part id, number of parts) of the current worker'''
+        rank, world_size = self.rank, self.world_size
+        if rank is None or world_size is None:
+            if dist.is_available() and dist.is_initialized():
+                rank, world_size = dist.get_rank(), dist.get_world_size()
+            else:
+                rank, world_size = 0, 1
+        info = get_worker_info()
+        if info is None:
+            return rank, world_size
+        return rank * info.num_workers + info.id, world_size * info.num_workers
+
+    def ranges(self, part, parts):
+        '''Return [(file, start, end)] covering the part-th of parts byte ranges'''
+        sizes = [path.getsize(f) for f in self.files]
+        total = sum(sizes)
+        begin = total * part // parts
+        end = total * (part + 1) // parts
+
+        ranges = []
+        offset = 0
+        for f, size in zip(self.files, sizes):
+            s, e = max(begin - offset, 0), min(end - offset, size)
+            if s < e:
+                ranges.append((f, s, e))
+            offset += size
+        return ranges
+
+    def lines(self):
+        for f, start, end in self.ranges(*self.part()):
+            for line in iter_lines(f, start, end, self.chunk_size):
+                yield line
+
+    def __iter__(self):
+        lines = self.lines()
+        if self.shuffle_buffer > 0:
+            part, _ = self.part()
+            rng = random.Random('%d-%d-%d' % (self.seed, self.epoch, part))
+            lines = shuffle_buffer(lines, self.shuffle_buffer, rng)
+        for line in lines:
+            yield self.transform(self.prepare(line))
+
+
+class LineStreamDataset(StreamDataset):
+    def __init__(self, key, *args, **keys):
+        super(LineStreamDataset, self).__init__(*args, **keys)
+        self.key = key
+
+    def prepare(self, line):
+        return {self.key: line.decode('utf-8')}
+
+
+class JsonLineStreamDataset(StreamDataset):
+    def __init__(self, *args, fields=None, **keys):
+        '''
+        fields (list[str] or None): keys kept from each record. None keeps all
+        '''
+        super(JsonLineStreamDataset, self).__init__(*args, **keys)
+        self.fields = list(fields) if fields is not None else None
+
+    def prepare(self, line):
+        record = json_loads(line)
+        if self.fields is None:
+            return record
+        return {k: record[k] for k in self.fields}
+
+
 def create_weights_for_balanced_classes(classes, class_key=None):
-    if class_key is None:
-        class_key = set(classes)
+    '''
+    Return the sampling weight of every sample (ndarray): the number of
+    samples divided by the number of samples of its class.
 
-    count = Counter(classes)
-    assert set(count.keys()) <= class_key, (count.keys(), class_key)
+    classes (array-like): class of every sample
+    class_key (set or None): all possible classes
+    '''
+    classes = np.asarray(classes)
+    keys, inverse, count = np.unique(classes.reshape(-1),
+                                     return_inverse=True,
+                                     return_counts=True)
+    if class_key is not None:
+        assert set(keys.tolist()) <= set(class_key), (keys, class_key)
 
-    N = float(sum(count.values()))
-    weight_per_class = {c: N / float(v) if v > 0 else 0 for c, v in count.items()}
-    weight = [weight_per_class[c] for c in classes]
-    return weight
+    weight_per_class = len(inverse) / count.astype(np.float64)
+    return weight_per_class[inverse]
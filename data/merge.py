@@ -1,4 +1,6 @@
+from torch.utils.data import get_worker_info
 from torch.utils.data.dataloader import default_collate
+from torch.nn.utils.rnn import pack_sequence
 import torch.nn.functional as F
 import torch
 
@@ -23,37 +25,120 @@ def mask(pad_size, max_len, value=1):
     return torch.ByteTensor([0] * (max_len - pad_size) + [1] * pad_size)
 
 
+def pad_sequences(values, pad_value=0, pin_memory=False):
+    '''
+    Pad tensors along the first dimension into one preallocated tensor.
+
+    values (list[Tensor]): tensors with the same trailing dimensions
+    pad_value: value of the padding
+    pin_memory (bool): allocate the result in pinned memory. Ignored in
+        DataLoader workers: pinning does not survive the transfer to the main
+        process, use DataLoader(pin_memory=True) there instead
+    Return (padded Tensor of shape (len(values), max_len, ...), lengths)
+    '''
+    lengths = torch.tensor([v.size(0) for v in values], dtype=torch.long)
+    max_len = int(lengths.max()) if len(values) > 0 else 0
+    first = values[0]
+    shape = (len(values), max_len) + tuple(first.shape[1:])
+    in_worker = get_worker_info() is not None
+    pin_memory = pin_memory and not in_worker
+    out = torch.empty(shape, dtype=first.dtype, device=first.device,
+                      pin_memory=pin_memory)
+    if in_worker:
+        # same as default_collate: avoid a copy when sent to the main process
+        out.share_memory_()
+    out.fill_(pad_value)
+    for i, v in enumerate(values):
+        out[i, :v.size(0)] = v
+    return out, lengths
+
+
+def length_mask(lengths, max_len):
+    '''Return a ByteTensor of shape (len(lengths), max_len): 1 on padding'''
+    positions = torch.arange(max_len, device=lengths.device)
+    return (positions.unsqueeze(0) >= lengths.unsqueeze(1)).to(torch.uint8)
+
+
+def ragged(values):
+    '''
+    Concatenate tensors along the first dimension.
+
+    values (list[Tensor])
+    Return (values Tensor, offsets, lengths): offsets[i] is the start of
+    values[i] in the concatenation (as EmbeddingBag offsets)
+    '''
+    lengths = torch.tensor([v.size(0) for v in values], dtype=torch.long)
+    offsets = torch.zeros_like(lengths)
+    torch.cumsum(lengths[:-1], 0, out=offsets[1:])
+    return torch.cat(values), offsets, lengths
+
+
+def ragged_to_padded(values, lengths, pad_value=0):
+    '''
+    Return a padded tensor of shape (len(lengths), max_len, ...) from
+    concatenated values.
+    '''
+    max_len = int(lengths.max()) if len(lengths) > 0 else 0
+    out = values.new_full((len(lengths), max_len) + tuple(values.shape[1:]),
+                          pad_value)
+    out[length_mask(lengths, max_len) == 0] = values
+    return out
+
+
+def ragged_to_packed(values, lengths, enforce_sorted=False):
+    '''Return a PackedSequence from concatenated values. lengths must be > 0'''
+    return pack_sequence(values.split(lengths.tolist()),
+                         enforce_sorted=enforce_sorted)
+
+
 def merge_samples(samples,
                   text_key=[],
                   ignore_key=[],
                   sortby=None,
                   pad_value=0,
-                  make_mask=False):
+                  make_mask=False,
+                  pin_memory=False,
+                  ragged_key=[]):
     '''
-    samples (list[sample])
+    samples (list[sample]): not modified
     text_key (list[str]): padding and mask
     ignore_key (list[str]): skip merging to a tensor
     sortby (lambda or None): sort samples in mini-batch
+    pin_memory (bool): write padded text into pinned memory (main process
+        only, see pad_sequences)
+    ragged_key (list[str]): concatenate without padding. adds
+        key + '_offsets' and key + '_lengths'. see ragged_to_padded and
+        ragged_to_packed
     '''
 
     if sortby:
         samples = sorted(samples, key=sortby)
 
-    for key in text_key:
-        if key not in samples[0]:
-            continue
-        max_len = max(samples, key=lambda x: x[key].size(0))[key].size(0)
-        for sample in samples:
-            sample[key], pad = padding(sample[key], max_len, pad_value)
-            if make_mask:
-                sample[key + '_mask'] = mask(pad, max_len)
-
     batch = {}
+    masks = {}
     for key in samples[0]:
-        if key in ignore_key:
-            batch[key] = [s[key] for s in samples]
+        values = [s[key] for s in samples]
+        if key in ragged_key:
+            batch[key], offsets, lengths = ragged(values)
+            masks[key + '_offsets'] = offsets
+            masks[key + '_lengths'] = lengths
+        elif key in text_key:
+            padded, lengths = pad_sequences(values, pad_value, pin_memory)
+            if make_mask:
+                masks[key + '_mask'] = length_mask(lengths, padded.size(1))
+            batch[key] = list(padded.unbind(0)) if key in ignore_key else padded
+        elif key in ignore_key:
+            batch[key] = values
         else:
-            batch[key] = default_collate([s[key] for s in samples])
+            batch[key] = default_collate(values)
+
+    for key in text_key:
+        if key + '_mask' in masks:
+            batch[key + '_mask'] = masks[key + '_mask']
+    for key in ragged_key:
+        if key + '_offsets' in masks:
+            batch[key + '_offsets'] = masks[key + '_offsets']
+            batch[key + '_lengths'] = masks[key + '_lengths']
 
     return batch
 
@@ -62,17 +147,218 @@ def merge_fn(text_key=[],
              ignore_key=[],
              sortby=None,
              pad_value=0,
-             make_mask=False):
+             make_mask=False,
+             pin_memory=False,
+             ragged_key=[]):
     '''make a collage_fn for text dataset
     text_key (list[str]): padding and mask
     ignore_key (list[str]): skip merging to a tensor
     sortby (lambda or None): sort samples in mini-batch
     padding (function(Tensor, max_len(int))): pad the Tensor
     make_mask (function(pad_size(int), max_len(int))): making mask
+    pin_memory (bool): write padded text into pinned memory (main process
+        only, see pad_sequences)
+    ragged_key (list[str]): concatenate without padding
     '''
 
     def merge(samples):
         return merge_samples(samples, text_key, ignore_key, sortby, pad_value,
-                             make_mask)
+                             make_mask, pin_memory, ragged_key)
 
     return merge
+
+
+class Packer(object):
+    '''
+    collate_fn packing the `key` tensors of several samples into rows of
+    row_len tokens, with no padding between samples.
+
+    Samples are placed first-fit. With `rows` set, samples which do not fit
+    in the rows of a batch are carried over to the next call; call flush()
+    after the last batch to get them. The carry lives in the calling
+    process, so `rows` is refused inside DataLoader workers: use
+    num_workers=0, or collate_fn=list and apply the Packer to the batches
+    of the loader in the main process. A sample longer than row_len raises
+    ValueError unless truncate is set: clip the samples beforehand (e.x.
+    ClipText) so that no tokens are lost silently.
+
+    The batch holds:
+        key: (rows, row_len) tokens, pad_value after the last sample of a row
+        key + '_segment': (rows, row_len) 1, 2, ... per sample in a row, 0 on
+            padding
+        key + '_position': (rows, row_len) position inside the sample
+        key + '_lengths': (samples, ) packed length of every sample
+        key + '_row': (samples, ) row of every sample
+    and the other keys of the samples, in packing order, merged by
+    default_collate (or kept as lists for ignore_key).
+    '''
+
+    def __init__(self,
+                 key,
+                 row_len,
+                 rows=None,
+                 pad_value=0,
+                 ignore_key=[],
+                 truncate=False):
+        '''
+        key (str): key of the 1-D tensors to pack
+        row_len (int): tokens per row
+        rows (int or None): rows per batch. None uses as many as needed
+        pad_value: value of the padding at the end of rows
+        ignore_key (list[str]): skip merging to a tensor
+        truncate (bool): cut samples longer than row_len to row_len tokens
+            (key + '_lengths' holds the packed length) instead of raising
+        '''
+        self.key = key
+        self.row_len = row_len
+        self.rows = rows
+        self.pad_value = pad_value
+        self.ignore_key = ignore_key
+        self.truncate = truncate
+        self.carry = []
+
+    def place(self, samples):
+        '''Return (rows of samples, samples which did not fit)'''
+        rows = []
+        free = []
+        rest = []
+        for s in samples:
+            n = s[self.key].size(0)
+            if n > self.row_len:
+                if not self.truncate:
+                    raise ValueError(
+                        'sample of %d tokens is longer than row_len %d. clip '
+                        'the samples or use truncate=True' % (n, self.row_len))
+                n = self.row_len
+            for r, f in enumerate(free):
+                if n <= f:
+                    rows[r].append(s)
+                    free[r] -= n
+                    break
+            else:
+                if self.rows is None or len(rows) < self.rows:
+                    rows.append([s])
+                    free.append(self.row_len - n)
+                else:
+                    rest.append(s)
+        return rows, rest
+
+    def merge(self, rows):
+        key = self.key
+        first = rows[0][0][key]
+        shape = (len(rows), self.row_len)
+        tokens = first.new_full(shape, self.pad_value)
+        segment = torch.zeros(shape, dtype=torch.long)
+        position = torch.zeros(shape, dtype=torch.long)
+        lengths = []
+        row_ids = []
+        packed = []
+        for r, row in enumerate(rows):
+            offset = 0
+            for seg, s in enumerate(row, 1):
+                t = s[key][:self.row_len]
+                n = t.size(0)
+                tokens[r, offset:offset + n] = t
+                segment[r, offset:offset + n] = seg
+                position[r, offset:offset + n] = torch.arange(n)
+                offset += n
+                lengths.append(n)
+                row_ids.append(r)
+                packed.append(s)
+
+        batch = {}
+        for k in packed[0]:
+            if k == key:
+                continue
+            values = [s[k] for s in packed]
+            batch[k] = values if k in self.ignore_key else default_collate(values)
+        batch[key] = tokens
+        batch[key + '_segment'] = segment
+        batch[key + '_position'] = position
+        batch[key + '_lengths'] = torch.tensor(lengths, dtype=torch.long)
+        batch[key + '_row'] = torch.tensor(row_ids, dtype=torch.long)
+        return batch
+
+    def __call__(self, samples):
+        if self.rows is not None and get_worker_info() is not None:
+            raise RuntimeError(
+                'Packer with rows carries samples over between calls and '
+                'loses them in DataLoader workers. Use num_workers=0 or apply '
+                'it to the batches in the main process')
+        pending = self.carry + list(samples)
+        rows, self.carry = self.place(pending)
+        return self.merge(rows)
+
+    def flush(self):
+        '''Return the batches of the carried over samples'''
+        batches = []
+        while self.carry:
+            batches.append(self(()))
+        return batches
+
+
+def pack_fn(key, row_len, rows=None, pad_value=0, ignore_key=[],
+            truncate=False):
+    '''make a packing collate_fn. see Packer'''
+    return Packer(key, row_len, rows, pad_value, ignore_key, truncate)
+
+
+def packed_attention_mask(segment):
+    '''
+    Return a BoolTensor of shape (rows, row_len, row_len) which is True
+    where a token may attend to another: same sample and not padding.
+
+    segment (Tensor): key + '_segment' of a packed batch
+    '''
+    same = segment.unsqueeze(2) == segment.unsqueeze(1)
+    return same & (segment != 0).unsqueeze(1)
+
+
+if __name__ == '__main__':
+    import time
+
+    def legacy_merge_samples(samples, text_key, make_mask):
+        '''merge_samples before preallocation. benchmark only'''
+        for key in text_key:
+            max_len = max(samples, key=lambda x: x[key].size(0))[key].size(0)
+            for sample in samples:
+                sample[key], pad = padding(sample[key], max_len)
+                if make_mask:
+                    sample[key + '_mask'] = mask(pad, max_len)
+        return {
+            key: default_collate([s[key] for s in samples])
+            for key in samples[0]
+        }
+
+    def make_batch(n):
+        g = torch.Generator().manual_seed(n)
+        lengths = torch.randint(1, 200, (n, ), generator=g).tolist()
+        return [{
+            'text': torch.randint(0, 30000, (l, ), generator=g),
+            'label': i % 3,
+        } for i, l in enumerate(lengths)]
+
+    for n in [32, 128, 512]:
+        samples = make_batch(n)
+        expected = legacy_merge_samples(make_batch(n), ['text'], True)
+        got = merge_samples(samples, ['text'], make_mask=True)
+        assert list(got) == list(expected)
+        for key in got:
+            assert torch.equal(got[key], expected[key]), key
+
+        repeat = 20
+        begin = time.time()
+        for _ in range(repeat):
+            legacy_merge_samples(make_batch(n), ['text'], True)
+        legacy = time.time() - begin
+        begin = time.time()
+        for _ in range(repeat):
+            make_batch(n)
+        base = time.time() - begin
+        legacy -= base
+        begin = time.time()
+        for _ in range(repeat):
+            merge_samples(samples, ['text'], make_mask=True)
+        new = time.time() - begin
+        print('batch %d: legacy %.2f ms, preallocated %.2f ms (x%.1f)' %
+              (n, legacy / repeat * 1e3, new / repeat * 1e3, legacy / new))
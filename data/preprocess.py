@@ -0,0 +1,230 @@
+'''
+Run a transformer over a whole line file ahead of training.
+
+    python -m data.preprocess corpus.jsonl out_dir --transformer mymodule:build
+
+`mymodule.build()` returns the transformer (or a list of transformers).
+Shards of the Reader index are transformed by a process pool and written in
+order as `<out_dir>/part-XXXXX.bin` (pickled samples, see DiskCache). Running
+the same command again resumes an interrupted run. Read the result with
+PreprocessedDataset.
+'''
+from multiprocessing import Pool
+from os import path, makedirs, replace
+import argparse
+import importlib
+import json
+import sys
+import time
+import numpy as np
+from .cache import DiskCache, fingerprint, file_fingerprint
+from .columnar import json_loads
+from .dataset import BaseDataset
+from .reader import Reader
+from .transformer import Chain
+
+ap = path.dirname(path.abspath(__file__))  # dataloader
+root = path.dirname(ap)  # root
+sys.path.append(root)
+from misc import OneLinePrint
+
+
+class ParseJson(object):
+    def __init__(self, fields=None):
+        self.fields = list(fields) if fields else None
+
+    def __call__(self, line):
+        record = json_loads(line)
+        if self.fields is None:
+            return record
+        return {k: record[k] for k in self.fields}
+
+
+class ParseLine(object):
+    def __init__(self, key):
+        self.key = key
+
+    def __call__(self, line):
+        return {self.key: line.decode('utf-8')}
+
+
+def shard_key(shard):
+    return 'part-%05d' % shard
+
+
+def meta_file(out_dir):
+    return path.join(out_dir, 'meta.json')
+
+
+def load_object(spec):
+    '''Return the object named by 'module:name' '''
+    module, name = spec.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+# set in each pool process by _init_worker
+_worker = {}
+
+
+def _init_worker(reader, parse, transformer, out_dir):
+    _worker.update(reader=reader,
+                   parse=parse,
+                   transformer=transformer,
+                   out_dir=out_dir)
+
+
+def _run_shard(task):
+    shard, start, end = task
+    reader, parse = _worker['reader'], _worker['parse']
+    transformer = _worker['transformer']
+
+    def samples():
+        for i in range(start, end):
+            sample = parse(reader.get(i, decode=False))
+            yield transformer(sample) if transformer else sample
+
+    DiskCache(_worker['out_dir'], shard_key(shard)).write(samples())
+    return shard, end - start
+
+
+def preprocess(data_file,
+               out_dir,
+               transformer=None,
+               parse=None,
+               shard_size=100000,
+               workers=None,
+               verbose=True):
+    '''
+    Transform every line of data_file and write the samples to out_dir.
+
+    Finished shards of a previous run with the same source, parser and
+    transformer are kept; a different configuration raises ValueError.
+
+    data_file (str): line file
+    out_dir (str)
+    transformer (callable, list or None)
+    parse (function(bytes) or None): converts a line into a sample.
+        default is ParseJson()
+    shard_size (int): samples per output shard
+    workers (int or None): processes of the pool. default is cpu count
+    verbose (bool): print progress and throughput
+    Returns: the meta data of the run (dict)
+    '''
+    if isinstance(transformer, list):
+        transformer = Chain(*transformer)
+    parse = parse if parse is not None else ParseJson()
+    reader = Reader(data_file, workers=workers, advice='sequential')
+    n = len(reader)
+
+    num_shards = (n + shard_size - 1) // shard_size
+    meta = {
+        'source': file_fingerprint(data_file),
+        'config': fingerprint(parse, transformer, shard_size),
+        'num_samples': n,
+        'shards': [shard_key(s) for s in range(num_shards)],
+    }
+    if path.isfile(meta_file(out_dir)):
+        with open(meta_file(out_dir)) as f:
+            if json.load(f) != meta:
+                raise ValueError(
+                    '%s holds the output of another configuration' % out_dir)
+    else:
+        if not path.isdir(out_dir):
+            makedirs(out_dir)
+        with open(meta_file(out_dir) + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        replace(meta_file(out_dir) + '.tmp', meta_file(out_dir))
+
+    tasks = []
+    for shard in range(len(meta['shards'])):
+        if not DiskCache(out_dir, shard_key(shard)).exists():
+            start = shard * shard_size
+            tasks.append((shard, start, min(start + shard_size, n)))
+
+    done = len(meta['shards']) - len(tasks)
+    processed = 0
+    begin = time.time()
+    printer = OneLinePrint()
+    with Pool(workers, _init_worker,
+              (reader, parse, transformer, out_dir)) as pool:
+        for _, count in pool.imap_unordered(_run_shard, tasks):
+            done += 1
+            processed += count
+            if verbose:
+                elapsed = time.time() - begin
+                with printer as write:
+                    write('shards %d/%d, %d samples, %.0f samples/s' %
+                          (done, len(meta['shards']), processed,
+                           processed / max(elapsed, 1e-9)))
+    if verbose:
+        print('')
+    reader.close()
+    return meta
+
+
+class PreprocessedDataset(BaseDataset):
+    '''Dataset over the samples written by preprocess'''
+
+    def __init__(self, out_dir, *args, **keys):
+        '''
+        out_dir (str): output directory given to preprocess
+        '''
+        keys.setdefault('save_trans', False)
+        super(PreprocessedDataset, self).__init__(*args, **keys)
+        self.out_dir = out_dir
+        with open(meta_file(out_dir)) as f:
+            self.meta = json.load(f)
+        self.data = [DiskCache(out_dir, key) for key in self.meta['shards']]
+        counts = []
+        for c in self.data:
+            assert c.exists(), '%s is not finished' % c.data_file
+            counts.append(len(np.load(c.idx_file, 'r')) - 1)
+        # cum[k] is the index of the first sample of shard k
+        self.cum = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def __len__(self):
+        return int(self.cum[-1])
+
+    def prepare(self, idx):
+        if idx < 0:
+            idx += len(self)
+        shard = int(np.searchsorted(self.cum, idx, side='right')) - 1
+        return self.data[shard][idx - int(self.cum[shard])]
+
+    def prepare_many(self, indices):
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        shards = np.searchsorted(self.cum, indices, side='right') - 1
+        samples = [None] * len(indices)
+        for shard in np.unique(shards).tolist():
+            pos = np.flatnonzero(shards == shard)
+            cache = self.data[shard]
+            for p, i in zip(pos.tolist(),
+                            (indices[pos] - self.cum[shard]).tolist()):
+                samples[p] = cache[i]
+        return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('data_file', help='line file')
+    parser.add_argument('out_dir')
+    parser.add_argument('--transformer',
+                        help="'module:name' of a function returning the "
+                        'transformer or a list of transformers')
+    parser.add_argument('--key',
+                        help='read each line as {key: line} instead of json')
+    parser.add_argument('--fields', nargs='*', help='json fields to keep')
+    parser.add_argument('--shard-size', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, '')
+    transformer = load_object(args.transformer)() if args.transformer else None
+    parse = ParseLine(args.key) if args.key else ParseJson(args.fields)
+    preprocess(args.data_file, args.out_dir, transformer, parse,
+               args.shard_size, args.workers)
+
+
+if __name__ == '__main__':
+    main()
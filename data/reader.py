@@ -1,8 +1,23 @@
+import os
 from os import path
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
 import mmap
 # import pickle
 import numpy as np
 
+NEWLINE = ord('\n')
+# bytes scanned per numpy pass when building indexes
+CHUNK_SIZE = 1 << 24
+# files larger than this are split across a process pool
+PARALLEL_THRESHOLD = 1 << 30
+# access pattern -> madvise flag name
+MADVISE = {
+    'normal': 'MADV_NORMAL',
+    'random': 'MADV_RANDOM',
+    'sequential': 'MADV_SEQUENTIAL',
+}
+
 
 def utf8len(s):
     '''
@@ -18,32 +33,129 @@ def utf8len(s):
     return len(s.encode('utf-8'))
 
 
+def _newline_offsets(args):
+    '''
+    Return byte offsets just after every newline in data_file[start:end].
+
+    args (tuple): (data_file, start, end, chunk_size)
+    '''
+    data_file, start, end, chunk_size = args
+    offsets = []
+    buf = bytearray(chunk_size)
+    with open(data_file, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            n = f.readinto(memoryview(buf)[:min(chunk_size, end - pos)])
+            if n == 0:
+                break
+            arr = np.frombuffer(buf, dtype=np.uint8, count=n)
+            offsets.append(np.flatnonzero(arr == NEWLINE) + (pos + 1))
+            pos += n
+    if len(offsets) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(offsets).astype(np.int64, copy=False)
+
+
+def build_idx(data_file, workers=None, chunk_size=CHUNK_SIZE):
+    '''
+    Return the line index of data_file: the byte offset of every line start
+    followed by the file size.
+
+    data_file (str): line file
+    workers (int or None): number of processes. None uses a single process
+        below PARALLEL_THRESHOLD bytes and all cores above it.
+    chunk_size (int): bytes read per numpy pass
+    '''
+    size = path.getsize(data_file)
+    if workers is None:
+        workers = cpu_count() if size >= PARALLEL_THRESHOLD else 1
+
+    if workers > 1 and size > chunk_size:
+        step = -(-size // workers)
+        ranges = [(data_file, s, min(s + step, size), chunk_size)
+                  for s in range(0, size, step)]
+        with Pool(workers) as pool:
+            parts = pool.map(_newline_offsets, ranges)
+    else:
+        parts = [_newline_offsets((data_file, 0, size, chunk_size))]
+
+    parts.insert(0, np.zeros(1, dtype=np.int64))
+    # the last line may not end with a newline
+    if size > 0 and (len(parts[-1]) == 0 or parts[-1][-1] != size):
+        parts.append(np.asarray([size], dtype=np.int64))
+    return np.concatenate(parts)
+
+
+def idx_is_stale(data_file, idx_file):
+    '''Return True if idx_file is missing or older than data_file'''
+    if not path.exists(idx_file):
+        return True
+    return path.getmtime(idx_file) < path.getmtime(data_file)
+
+
 class Reader(object):
     '''
     ReadOneline data. Using indexes for faster read.
+
+    The data file is mapped read-only on first access and mapped again in
+    every new process, so forked DataLoader workers never share the parent's
+    mapping. Pickling keeps only the paths; the index is reloaded from the
+    index file.
     '''
 
-    def __init__(self, data_file, idx_file=None):
+    def __init__(self, data_file, idx_file=None, workers=None, advice=None):
+        '''
+        data_file (str): line file
+        idx_file (str or None): index file. default is data_file + '.idx'
+        workers (int or None): number of processes used to build the index
+        advice (str or None): access pattern passed to madvise. 'random',
+            'sequential', 'normal' or None (no hint)
+        '''
+        assert advice is None or advice in MADVISE, advice
         self.data_file = data_file
         self.idx_file = idx_file if idx_file else data_file + '.idx'
+        self.workers = workers
+        self.advice = advice
 
-        if not path.exists(self.idx_file):
-            self.create_idx()
-        elif path.getmtime(self.idx_file) < path.getmtime(self.data_file):
+        if idx_is_stale(self.data_file, self.idx_file):
             self.create_idx()
 
         self.idx = self.load_idx()
 
-        f = open(self.data_file, 'r+b')
-        self.mm = mmap.mmap(f.fileno(), 0)
+        self._mm = None
+        self._pid = None
+
+    @property
+    def mm(self):
+        if self._pid != os.getpid():
+            self._open()
+        return self._mm
+
+    def _open(self):
+        # a mapping inherited from the parent process is dropped, not closed
+        with open(self.data_file, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._pid = os.getpid()
+        self.madvise(self.advice)
+
+    def madvise(self, advice):
+        '''
+        Hint the access pattern of the mapping to the kernel. Ignored on
+        platforms without madvise.
+
+        advice (str or None): 'random', 'sequential', 'normal' or None
+        '''
+        assert advice is None or advice in MADVISE, advice
+        self.advice = advice
+        if advice is None or self._mm is None:
+            return
+        flag = getattr(mmap, MADVISE[advice], None)
+        if flag is not None and hasattr(self._mm, 'madvise'):
+            self._mm.madvise(flag)
 
     def create_idx(self):
-        idx = [0]
-        with open(self.data_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                idx.append(utf8len(line))
-        idx = np.asarray(idx)
-        idx = np.cumsum(idx)
+        idx = build_idx(self.data_file, self.workers)
 
         with open(self.idx_file, 'wb') as f:
             np.save(f, idx)
@@ -53,18 +165,189 @@ class Reader(object):
         return np.load(self.idx_file, 'r')
         # return pickle.load(open(self.idx_file, 'rb'))  # 44ms
 
+    def span(self, i):
+        '''Return (start, end) byte offsets of the line i'''
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('index out of range: %d' % i)
+        return int(self.idx[i]), int(self.idx[i + 1])
+
+    def get(self, i, decode=True):
+        '''
+        Return the line i. Slices the mmap without moving its cursor.
+
+        decode (bool): if False, return bytes
+        '''
+        start, end = self.span(i)
+        line = self.mm[start:end]
+        return line.decode('utf-8') if decode else line
+
+    def get_many(self, indices, decode=True, copy=True):
+        '''
+        Return the lines of indices in the given order. The lines are read in
+        file order.
+
+        indices (list[int] or ndarray)
+        decode (bool): if False, return bytes (or memoryview)
+        copy (bool): only used if decode is False. if False, return
+            memoryviews of the mmap without copying. They must be released
+            before the Reader is closed.
+        '''
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        n = len(self)
+        indices = np.where(indices < 0, indices + n, indices)
+        if len(indices) > 0 and (indices.min() < 0 or indices.max() >= n):
+            raise IndexError('index out of range')
+
+        starts = self.idx[indices]
+        ends = self.idx[indices + 1]
+        order = np.argsort(starts, kind='stable').tolist()
+        starts = starts.tolist()
+        ends = ends.tolist()
+
+        lines = [None] * len(starts)
+        buf = self.mm if decode or copy else memoryview(self.mm)
+        for j in order:
+            lines[j] = buf[starts[j]:ends[j]]
+        if decode:
+            lines = [line.decode('utf-8') for line in lines]
+        return lines
+
     def __getitem__(self, i):
-        idx = self.idx[i]
-        self.mm.seek(idx)
-        return self.mm.readline().decode('utf-8')
+        return self.get(i)
 
     def __len__(self):
         return len(self.idx) - 1
 
+    def close(self):
+        if self._mm is not None and self._pid == os.getpid():
+            self._mm.close()
+        self._mm = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['idx'] = None
+        state['_mm'] = None
+        state['_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.idx = self.load_idx()
+
+
+class ShardedReader(object):
+    '''
+    Read lines from many line files through one global index.
+
+    Each shard keeps its own Reader index file. Only the line counts are kept
+    in memory; shard Readers are opened on first access and at most
+    `max_open` of them stay open (least recently used ones are closed).
+    '''
+
+    def __init__(self, data_files, max_open=64, workers=None, advice=None):
+        '''
+        data_files (list[str]): line files in global order
+        max_open (int): maximum number of shard Readers kept open
+        workers (int or None): number of processes used to build indexes
+        advice (str or None): madvise access pattern of the shards. see Reader
+        '''
+        assert len(data_files) > 0
+        assert max_open > 0, max_open
+        self.data_files = list(data_files)
+        self.max_open = max_open
+        self.workers = workers
+        self.advice = advice
+
+        counts = []
+        for data_file in self.data_files:
+            idx_file = data_file + '.idx'
+            if idx_is_stale(data_file, idx_file):
+                with open(idx_file, 'wb') as f:
+                    np.save(f, build_idx(data_file, workers))
+            counts.append(len(np.load(idx_file, 'r')) - 1)
+        # cum[k] is the global line number of the first line of shard k
+        self.cum = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        self.readers = OrderedDict()
+
+    def locate(self, i):
+        '''Return (shard, line number in the shard) of the global line i'''
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('index out of range: %d' % i)
+        shard = int(np.searchsorted(self.cum, i, side='right')) - 1
+        return shard, int(i - self.cum[shard])
+
+    def reader(self, shard):
+        '''Return the Reader of the shard, opening it if needed'''
+        r = self.readers.get(shard)
+        if r is not None:
+            self.readers.move_to_end(shard)
+            return r
+
+        while len(self.readers) >= self.max_open:
+            _, old = self.readers.popitem(last=False)
+            old.close()
+        r = self.readers[shard] = Reader(self.data_files[shard],
+                                         advice=self.advice)
+        return r
+
+    def get(self, i, decode=True):
+        shard, j = self.locate(i)
+        return self.reader(shard).get(j, decode)
+
+    def get_many(self, indices, decode=True, copy=True):
+        '''Return the lines of indices in the given order. See Reader.get_many'''
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        n = len(self)
+        indices = np.where(indices < 0, indices + n, indices)
+        if len(indices) > 0 and (indices.min() < 0 or indices.max() >= n):
+            raise IndexError('index out of range')
+
+        shards = np.searchsorted(self.cum, indices, side='right') - 1
+        lines = [None] * len(indices)
+        for shard in np.unique(shards).tolist():
+            pos = np.flatnonzero(shards == shard)
+            got = self.reader(shard).get_many(indices[pos] - self.cum[shard],
+                                              decode, copy)
+            for p, line in zip(pos.tolist(), got):
+                lines[p] = line
+        return lines
+
+    def __getitem__(self, i):
+        return self.get(i)
+
+    def __len__(self):
+        return int(self.cum[-1])
+
+    def close(self):
+        for r in self.readers.values():
+            r.close()
+        self.readers.clear()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['readers'] = OrderedDict()
+        return state
+
+
+def _create_idx_legacy(data_file):
+    '''line-by-line index construction used before build_idx. benchmark only'''
+    idx = [0]
+    with open(data_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            idx.append(utf8len(line))
+    return np.cumsum(np.asarray(idx))
+
 
 if __name__ == '__main__':
     from tempfile import NamedTemporaryFile
     import os
+    import time
     t = NamedTemporaryFile()
     with open(t.name, 'w') as f:
         f.write('あああ\n')
@@ -72,5 +355,49 @@ if __name__ == '__main__':
     r = Reader(t.name)
     assert len(r) == 2, len(r)
     assert r[1] == 'bbbb\n', r[2]
-    print('ok')
     os.remove(r.idx_file)
+
+    with open(t.name, 'w') as f:
+        f.write('あああ\nbbbb')
+    assert (build_idx(t.name) == _create_idx_legacy(t.name)).all()
+
+    t2 = NamedTemporaryFile()
+    with open(t2.name, 'w') as f:
+        f.write('cc\n')
+    sr = ShardedReader([t.name, t2.name], max_open=1)
+    assert len(sr) == 3, len(sr)
+    assert sr[1] == 'bbbb' and sr[2] == 'cc\n' and sr[0] == 'あああ\n'
+    assert len(sr.readers) == 1
+    assert sr.get_many([2, 0, -2]) == ['cc\n', 'あああ\n', 'bbbb']
+    r = Reader(t.name)
+    assert r.get_many([1, 0], decode=False) == [b'bbbb', 'あああ\n'.encode()]
+    assert bytes(r.get_many([1], decode=False, copy=False)[0]) == b'bbbb'
+    r.close()
+    import pickle
+    sr2 = pickle.loads(pickle.dumps(sr))
+    assert sr2[2] == 'cc\n' and len(sr2.readers) == 1
+    sr.close()
+    os.remove(t.name + '.idx')
+    os.remove(t2.name + '.idx')
+    print('ok')
+
+    # benchmark: build the index of a ~100MB file
+    with open(t.name, 'w', encoding='utf-8') as f:
+        line = 'あいうえお abcdefg ' * 4
+        for i in range(2000000):
+            f.write(line[:(i * 7) % len(line)] + '\n')
+    size = path.getsize(t.name)
+
+    begin = time.time()
+    legacy = _create_idx_legacy(t.name)
+    legacy_time = time.time() - begin
+    results = [('legacy', legacy_time)]
+    for workers in [1, cpu_count()]:
+        begin = time.time()
+        idx = build_idx(t.name, workers=workers, chunk_size=1 << 22)
+        results.append(('build_idx workers=%d' % workers, time.time() - begin))
+        assert (idx == legacy).all()
+
+    print('file size: %.1f MB, lines: %d' % (size / 1e6, len(legacy) - 1))
+    for name, elapsed in results:
+        print('%s: %.3f s (x%.1f)' % (name, elapsed, legacy_time / elapsed))
@@ -0,0 +1,256 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class ResumableRandomSampler(Sampler):
+    '''
+    Random sampler whose order is a function of (seed, epoch), so a
+    position inside an epoch can be restored without storing the order.
+    skip(n) makes the next iteration start after the first n indices.
+    '''
+
+    def __init__(self, data_source, shuffle=True, seed=0):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip(self, n):
+        '''skip the first n indices of the next iteration only'''
+        self.start = n
+
+    def indices(self):
+        n = len(self.data_source)
+        if not self.shuffle:
+            return np.arange(n)
+        return np.random.default_rng([self.seed, self.epoch]).permutation(n)
+
+    def __iter__(self):
+        start, self.start = self.start, 0
+        return iter(self.indices()[start:].tolist())
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+def dataset_lengths(dataset, key):
+    '''
+    Return the length of sample[key] of every sample as an int32 array.
+    Uses dataset.lengths(key) if the dataset has it, otherwise the
+    `key + '_len'` field added by ClipText, otherwise len(sample[key]).
+    '''
+    if hasattr(dataset, 'lengths'):
+        return np.asarray(dataset.lengths(key), dtype=np.int32)
+    lengths = np.empty(len(dataset), dtype=np.int32)
+    for i in range(len(dataset)):
+        sample = dataset[i]
+        if key + '_len' in sample:
+            lengths[i] = sample[key + '_len']
+        else:
+            lengths[i] = len(sample[key])
+    return lengths
+
+
+def padding_ratio(lengths, batches):
+    '''Return the ratio of padding in all tokens of the padded batches'''
+    lengths = np.asarray(lengths)
+    real = padded = 0
+    for batch in batches:
+        lens = lengths[batch]
+        real += int(lens.sum())
+        padded += int(lens.max()) * len(batch)
+    return 1 - real / padded if padded > 0 else 0.
+
+
+class BucketBatchSampler(Sampler):
+    '''
+    Batch sampler grouping samples of similar length.
+
+    The indices are shuffled and split into pools of bucket_size samples.
+    Each pool is sorted by length and cut into batches of batch_size
+    samples, or of at most max_tokens padded tokens. The order of the
+    batches is then shuffled. Use as DataLoader(batch_sampler=...).
+    The order is a function of (seed, epoch) and is kept until set_epoch
+    changes the epoch: call set_epoch every epoch (Runner does) to get a new
+    order.
+    '''
+
+    def __init__(self,
+                 lengths,
+                 batch_size=None,
+                 max_tokens=None,
+                 bucket_size=None,
+                 shuffle=True,
+                 drop_last=False,
+                 seed=0):
+        '''
+        lengths (array-like): length of every sample. see dataset_lengths
+        batch_size (int or None): maximum number of samples in a batch
+        max_tokens (int or None): maximum of (longest length * batch size)
+        bucket_size (int or None): samples sorted together. default is
+            100 batches (100 * batch_size, or 10000 with max_tokens only)
+        shuffle (bool)
+        drop_last (bool): drop the last batch of each pool if it is smaller
+            than batch_size. ignored with max_tokens, whose batches vary in
+            size anyway
+        seed (int)
+        '''
+        assert batch_size or max_tokens
+        self.lengths = np.asarray(lengths, dtype=np.int32)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        if bucket_size is None:
+            bucket_size = 100 * batch_size if batch_size else 10000
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self._batches = None
+        self.epoch = epoch
+
+    def skip(self, n):
+        '''skip the first n batches of the next iteration only'''
+        self.start = n
+
+    def split(self, indices):
+        '''cut indices sorted by length into batches'''
+        if self.max_tokens is None:
+            bs = self.batch_size
+            return [indices[i:i + bs] for i in range(0, len(indices), bs)]
+
+        batches = []
+        batch = []
+        for i, length in zip(indices, self.lengths[indices].tolist()):
+            full = self.batch_size is not None and len(batch) >= self.batch_size
+            if batch and (full or length * (len(batch) + 1) > self.max_tokens):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def batches(self):
+        '''Return the batches of the current epoch'''
+        if self._batches is not None:
+            return self._batches
+
+        rng = np.random.default_rng([self.seed, self.epoch])
+        n = len(self.lengths)
+        order = rng.permutation(n) if self.shuffle else np.arange(n)
+
+        batches = []
+        for start in range(0, n, self.bucket_size):
+            pool = order[start:start + self.bucket_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(self.split(pool.tolist()))
+
+        if self.drop_last and self.max_tokens is None:
+            # only the last batch of a pool can be smaller than batch_size
+            batches = [b for b in batches if len(b) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        self._batches = batches
+        return batches
+
+    def __iter__(self):
+        start, self.start = self.start, 0
+        return iter(self.batches()[start:])
+
+    def __len__(self):
+        return len(self.batches())
+
+
+class ClassBalancedSampler(Sampler):
+    '''
+    Sample indices with replacement so that every class is drawn with the
+    same probability (or with class_weights).
+
+    Same distribution as WeightedRandomSampler with the weights of
+    create_weights_for_balanced_classes, but indices are grouped by class
+    once, so a draw is a class choice plus a uniform offset into that class
+    and an epoch of indices is generated with a few numpy calls.
+    '''
+
+    def __init__(self, classes, num_samples=None, class_weights=None, seed=0):
+        '''
+        classes (array-like): class of every sample
+        num_samples (int or None): indices per epoch. default is len(classes)
+        class_weights (dict or None): relative probability of each class.
+            default is uniform over the classes present
+        seed (int)
+        '''
+        classes = np.asarray(classes).reshape(-1)
+        keys, inverse, counts = np.unique(classes,
+                                          return_inverse=True,
+                                          return_counts=True)
+        self.keys = keys
+        self.counts = counts
+        # indices of class k are order[starts[k]:starts[k] + counts[k]]
+        self.order = np.argsort(inverse, kind='stable')
+        self.starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+        if class_weights is None:
+            p = np.ones(len(keys))
+        else:
+            p = np.asarray([class_weights.get(k, 0) for k in keys.tolist()],
+                           dtype=np.float64)
+        assert p.sum() > 0
+        self.p = p / p.sum()
+
+        self.num_samples = num_samples if num_samples else len(classes)
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip(self, n):
+        '''skip the first n indices of the next iteration only'''
+        self.start = n
+
+    def indices(self):
+        '''Return the indices of the current epoch as an array'''
+        rng = np.random.default_rng([self.seed, self.epoch])
+        cls = rng.choice(len(self.p), size=self.num_samples, p=self.p)
+        offsets = (rng.random(self.num_samples) * self.counts[cls]).astype(
+            np.int64)
+        return self.order[self.starts[cls] + offsets]
+
+    def __iter__(self):
+        start, self.start = self.start, 0
+        return iter(self.indices()[start:].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    lengths = np.clip(rng.lognormal(3.5, 0.8, 200000), 1, 512).astype(np.int32)
+
+    order = rng.permutation(len(lengths)).tolist()
+    random_batches = [order[i:i + 64] for i in range(0, len(order), 64)]
+    print('random batches (64): padding %.3f' %
+          padding_ratio(lengths, random_batches))
+
+    sampler = BucketBatchSampler(lengths, batch_size=64)
+    print('bucketed batches (64): padding %.3f' %
+          padding_ratio(lengths, sampler))
+
+    sampler = BucketBatchSampler(lengths, max_tokens=64 * 48)
+    sizes = [len(b) for b in sampler]
+    print('bucketed batches (max_tokens=%d): padding %.3f, %d batches of '
+          '%d-%d samples' % (64 * 48, padding_ratio(lengths, sampler),
+                             len(sizes), min(sizes), max(sizes)))
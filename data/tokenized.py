@@ -0,0 +1,155 @@
+from array import array
+import json
+import numpy as np
+import torch
+from .dataset import BaseDataset
+from .reader import Reader
+from .transformer import Chain
+
+# ids are written as uint16 while the vocabulary fits in it
+UINT16_VOCAB_SIZE = 1 << 16
+
+
+def token_dtype(vocab_size):
+    '''Return the smallest dtype name able to hold ids of the vocabulary'''
+    return 'uint16' if vocab_size <= UINT16_VOCAB_SIZE else 'int32'
+
+
+def tokens_file(prefix, key):
+    return '%s.%s.tok' % (prefix, key)
+
+
+def offsets_file(prefix, key):
+    return '%s.%s.off' % (prefix, key)
+
+
+def meta_file(prefix):
+    return prefix + '.json'
+
+
+def build_tokenized(data_file,
+                    prefix,
+                    vocab,
+                    keys,
+                    transformer=None,
+                    parse=json.loads,
+                    flush_size=1 << 20):
+    '''
+    Tokenize a line file once and write it as flat token arrays.
+
+    For every key, `<prefix>.<key>.tok` holds the ids of all samples back to
+    back and `<prefix>.<key>.off` (npy) the offset of each sample in it.
+    `<prefix>.json` is written last and describes the corpus.
+
+    data_file (str): line file
+    prefix (str): output path prefix
+    vocab (Vocab): maps tokens to ids
+    keys (list[str]): keys holding token lists after the transformer
+    transformer (callable, list or None): applied to each parsed line
+    parse (function(str)): converts a line into a sample (dict)
+    flush_size (int): number of ids buffered before writing
+    '''
+    if isinstance(transformer, list):
+        transformer = Chain(*transformer)
+    dtype = token_dtype(len(vocab))
+    reader = Reader(data_file, advice='sequential')
+
+    files = {key: open(tokens_file(prefix, key), 'wb') for key in keys}
+    lengths = {key: array('q') for key in keys}
+    buffers = {key: array('l') for key in keys}
+    try:
+        for i in range(len(reader)):
+            sample = parse(reader[i])
+            if transformer is not None:
+                sample = transformer(sample)
+            for key in keys:
+                ids = [vocab.word2id(w) for w in sample[key]]
+                buffers[key].extend(ids)
+                lengths[key].append(len(ids))
+                if len(buffers[key]) >= flush_size:
+                    np.asarray(buffers[key], dtype=dtype).tofile(files[key])
+                    buffers[key] = array('l')
+        for key in keys:
+            np.asarray(buffers[key], dtype=dtype).tofile(files[key])
+    finally:
+        for f in files.values():
+            f.close()
+        reader.close()
+
+    for key in keys:
+        offsets = np.zeros(len(lengths[key]) + 1, dtype=np.int64)
+        np.cumsum(np.frombuffer(lengths[key], dtype=np.int64), out=offsets[1:])
+        with open(offsets_file(prefix, key), 'wb') as f:
+            np.save(f, offsets)
+
+    meta = {
+        'keys': list(keys),
+        'dtype': dtype,
+        'vocab_size': len(vocab),
+        'num_samples': len(reader),
+    }
+    with open(meta_file(prefix), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+class TokenizedDataset(BaseDataset):
+    '''
+    Dataset over a corpus written by build_tokenized.
+
+    A sample is {key: LongTensor of ids, key + '_len': length} for every key
+    of the corpus, sliced from memory-mapped token arrays.
+    '''
+
+    def __init__(self, prefix, *args, **keys):
+        '''
+        prefix (str): path prefix given to build_tokenized
+        '''
+        keys.setdefault('save_trans', False)
+        super(TokenizedDataset, self).__init__(*args, **keys)
+        self.prefix = prefix
+        with open(meta_file(prefix)) as f:
+            self.meta = json.load(f)
+        self.keys = self.meta['keys']
+        self._tokens = None
+        self._offsets = None
+
+    def _load(self):
+        self._tokens = {}
+        self._offsets = {}
+        for key in self.keys:
+            offsets = np.load(offsets_file(self.prefix, key), 'r')
+            if offsets[-1] > 0:
+                tokens = np.memmap(tokens_file(self.prefix, key),
+                                   dtype=self.meta['dtype'], mode='r')
+            else:
+                tokens = np.zeros(0, dtype=self.meta['dtype'])
+            self._tokens[key] = tokens
+            self._offsets[key] = offsets
+
+    def lengths(self, key):
+        '''Return the number of ids of every sample as an array'''
+        if self._offsets is None:
+            self._load()
+        return np.diff(self._offsets[key])
+
+    def __len__(self):
+        return self.meta['num_samples']
+
+    def prepare(self, idx):
+        if self._tokens is None:
+            self._load()
+        sample = {}
+        for key in self.keys:
+            offsets = self._offsets[key]
+            start, end = int(offsets[idx]), int(offsets[idx + 1])
+            ids = self._tokens[key][start:end].astype(np.int64)
+            sample[key] = torch.from_numpy(ids)
+            sample[key + '_len'] = end - start
+        return sample
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tokens'] = None
+        state['_offsets'] = None
+        return state
@@ -1,6 +1,15 @@
-from os import path
+from collections import Counter
+from multiprocessing import Pool
+from os import path, replace
+from hashlib import sha1
+from shutil import copyfile
+import heapq
+import mmap
+import struct
 import sys
+import zlib
 import numpy as np
+from .reader import ShardedReader
 
 ap = path.dirname(path.abspath(__file__))  # dataloader
 root = path.dirname(ap)  # root
@@ -18,6 +27,9 @@ UNKNOWN_TOKEN = "<unk>"
 class Vocab(object):
     """単語とidをmappingするクラス"""
 
+    # _words is rebuilt from _id_to_word; not part of the fingerprint
+    _volatile = ("_words",)
+
     def __init__(self, vocab_file, max_size, min_feq=0, lower=False, verbose=False):
         """
         Args:
@@ -38,9 +50,10 @@ class Vocab(object):
         self.special_tokens = special_tokens = [PAD_TOKEN]
         for w in special_tokens:
             self._add_word(w)
-        self.special_ids = [self.word2id(w) for w in self.special_tokens]
+        self.special_ids = [self._word_to_id[w] for w in self.special_tokens]
 
         self._add_word(UNKNOWN_TOKEN)
+        self.unk_id = self._word_to_id[UNKNOWN_TOKEN]
         self._add_word(SENTENCE_START)
         self._add_word(SENTENCE_END)
 
@@ -78,7 +91,11 @@ class Vocab(object):
         logger.debug("Finished loading vocabulary")
 
         self.pad_id = self.word2id(PAD_TOKEN)
-        self.unk_id = self.word2id(UNKNOWN_TOKEN)
+        self.end_id = self.word2id(SENTENCE_END)
+        # words in id order; the last "" is the word of id -1
+        self._words = np.array(
+            [self._id_to_word[i] for i in range(self._counter)] + [""],
+            dtype=object)
 
     def _add_word(self, word):
         self._word_to_id[word] = self._counter
@@ -87,9 +104,7 @@ class Vocab(object):
 
     def word2id(self, word):
         """word(string)に対応するid(integer)を返す"""
-        if word not in self._word_to_id:
-            return self._word_to_id[UNKNOWN_TOKEN]
-        return self._word_to_id[word]
+        return self._word_to_id.get(word, self.unk_id)
 
     def id2word(self, id):
         """id(integer)に対応するword(string)を返す"""
@@ -101,9 +116,79 @@ class Vocab(object):
         return self.word2id(key)
 
     def DecodeIds(self, words):
-        text = " ".join([self._id_to_word[id] for id in words])
+        ids = np.asarray(words, dtype=np.int64)
+        self._check_ids(ids)
+        text = " ".join(self._words[ids])
         return text
 
+    def encode_batch(self, sentences, max_len=None):
+        """
+        Args:
+            sentences: list of word lists.
+            max_len: wordsを切り取る長さ. Noneなら最長の文に合わせる.
+        Returns:
+            ids: (batch, length) int64 ndarray. padding is pad_id.
+            lengths: (batch) int64 ndarray.
+        """
+        lengths = np.fromiter(map(len, sentences), dtype=np.int64,
+                              count=len(sentences))
+        if max_len is not None:
+            sentences = [s[:max_len] for s in sentences]
+            np.minimum(lengths, max_len, out=lengths)
+        total = int(lengths.sum())
+        flat = np.fromiter(
+            map(self.word2id, (w for s in sentences for w in s)),
+            dtype=np.int64, count=total)
+
+        width = int(lengths.max()) if len(lengths) else 0
+        ids = np.full((len(sentences), width), self.pad_id, dtype=np.int64)
+        ids[np.arange(width) < lengths[:, None]] = flat
+        return ids, lengths
+
+    def decode_batch(self, ids, stop_id=None, skip_ids=None):
+        """
+        Args:
+            ids: (batch, length) ndarray, tensor or list of id sequences.
+            stop_id: この id 以降を切り捨てる (e.x. vocab.end_id).
+            skip_ids: 取り除く ids. デフォルトは [pad_id].
+        Returns:
+            list of texts (words joined by spaces).
+        """
+        ids, lengths = self._id_matrix(ids)
+        self._check_ids(ids)
+
+        keep = ~np.isin(ids, list(skip_ids) if skip_ids is not None
+                        else [self.pad_id])
+        # the padding added to ragged rows is removed whatever skip_ids is
+        keep &= np.arange(ids.shape[1]) < lengths[:, None]
+        if stop_id is not None:
+            stop = ids == stop_id
+            cut = np.where(stop.any(1), stop.argmax(1), ids.shape[1])
+            keep &= np.arange(ids.shape[1]) < cut[:, None]
+        words = self._words[ids]
+        return [" ".join(w[k]) for w, k in zip(words, keep)]
+
+    def _check_ids(self, ids):
+        # -1 is the only id outside the vocab allowed; it decodes to ""
+        if ids.size and (ids.min() < -1 or ids.max() >= self._counter):
+            raise ValueError("Id not found in vocab: %d" % (
+                ids.min() if ids.min() < -1 else ids.max()))
+
+    def _id_matrix(self, ids):
+        """Return (batch, length) int64 ids and the length of each row"""
+        if hasattr(ids, "detach"):
+            ids = ids.detach().cpu().numpy()
+        if isinstance(ids, np.ndarray):
+            ids = ids.astype(np.int64, copy=False).reshape(len(ids), -1)
+            return ids, np.full(len(ids), ids.shape[1], dtype=np.int64)
+        rows = [np.asarray(r, dtype=np.int64).reshape(-1) for r in ids]
+        lengths = np.array([len(r) for r in rows], dtype=np.int64)
+        width = int(lengths.max()) if len(rows) else 0
+        matrix = np.full((len(rows), width), self.pad_id, dtype=np.int64)
+        for i, r in enumerate(rows):
+            matrix[i, :len(r)] = r
+        return matrix, lengths
+
     @property
     def size(self):
         return self._counter
@@ -111,20 +196,218 @@ class Vocab(object):
     def __len__(self):
         return self._counter
 
+    def save_binary(self, file):
+        """BinaryVocabで読み込める形式で保存する"""
+        words = [self._id_to_word[i].encode("utf-8")
+                 for i in range(self._counter)]
+        offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum([len(w) for w in words], out=offsets[1:])
+
+        n_slots = 1
+        while n_slots < 2 * len(words):
+            n_slots *= 2
+        slots = np.full(n_slots, -1, dtype=np.int32)
+        for i, w in enumerate(words):
+            h = zlib.crc32(w) & (n_slots - 1)
+            while slots[h] >= 0:
+                h = (h + 1) & (n_slots - 1)
+            slots[h] = i
+
+        body = [offsets.tobytes(), slots.tobytes(), b"".join(words)]
+        digest = sha1()
+        for b in body:
+            digest.update(b)
+        with open(file + ".tmp", "wb") as f:
+            f.write(_BINARY_HEADER.pack(
+                _BINARY_MAGIC, len(words), n_slots, digest.digest()))
+            for b in body:
+                f.write(b)
+        replace(file + ".tmp", file)
+
+
+# magic, number of words, number of hash slots, sha1 of the rest. followed
+# by int64 offsets[n + 1], int32 slots[n_slots] and the utf-8 words
+_BINARY_HEADER = struct.Struct("<8sqq20s4x")
+_BINARY_MAGIC = b"VOCABBN2"
+
+
+class BinaryVocab(Vocab):
+    """
+    Vocab.save_binaryで保存した語彙をmmapで読み込むクラス.
+
+    The file is mapped read-only, so loading takes no time and the pages are
+    shared by all processes. Words are found through an open addressing hash
+    table (crc32) stored in the file. Ids are the same as the ones of Vocab.
+    A lookup probes the table in python (about 9x slower than Vocab); call
+    load() to build the word dict when word2id is on a hot path.
+    The vocabulary is fingerprinted by its file and the sha1 of its contents.
+    """
+
+    _volatile = ("_mm", "_offsets", "_slots", "_words_array", "_word_to_id")
+
+    def __init__(self, file):
+        self.file = file
+        self._word_to_id = None
+        self._open()
+        self.special_tokens = [PAD_TOKEN]
+        self.special_ids = [self.word2id(w) for w in self.special_tokens]
+        self.unk_id = self.word2id(UNKNOWN_TOKEN)
+        self.pad_id = self.word2id(PAD_TOKEN)
+        self.end_id = self.word2id(SENTENCE_END)
+
+    def _open(self):
+        # the read-only mapping stays valid in forked processes
+        with open(self.file, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, n_slots, digest = _BINARY_HEADER.unpack_from(self._mm, 0)
+        if magic != _BINARY_MAGIC:
+            raise ValueError("Not a binary vocab file: %s" % self.file)
+        self.digest = digest.hex()
+        self._counter = n
+        self._mask = n_slots - 1
 
-def restore_text(data, vocab, skips=[]):
+        view = memoryview(self._mm)
+        start = _BINARY_HEADER.size
+        self._offsets = view[start:start + 8 * (n + 1)].cast("q")
+        start += 8 * (n + 1)
+        self._slots = view[start:start + 4 * n_slots].cast("i")
+        self._blob = start + 4 * n_slots
+        self._words_array = None
+
+    def load(self):
+        """全単語のdictを作る. word2idがVocabと同じ速さになる"""
+        self._word_to_id = {w: i for i, w in enumerate(self._words[:-1].tolist())}
+        return self
+
+    def word2id(self, word):
+        """word(string)に対応するid(integer)を返す"""
+        if self._word_to_id is not None:
+            return self._word_to_id.get(word, self.unk_id)
+        data = word.encode("utf-8")
+        offsets, slots, mm = self._offsets, self._slots, self._mm
+        blob = self._blob
+        h = zlib.crc32(data) & self._mask
+        while True:
+            i = slots[h]
+            if i < 0:
+                return self.unk_id
+            if mm[blob + offsets[i]:blob + offsets[i + 1]] == data:
+                return i
+            h = (h + 1) & self._mask
+
+    def id2word(self, id):
+        """id(integer)に対応するword(string)を返す"""
+        if id == -1:
+            return ""
+        if not 0 <= id < self._counter:
+            raise ValueError("Id not found in vocab: %d" % id)
+        start = self._blob + self._offsets[id]
+        end = self._blob + self._offsets[id + 1]
+        return self._mm[start:end].decode("utf-8")
+
+    @property
+    def _words(self):
+        # built on the first bulk decode
+        if self._words_array is None:
+            blob = self._mm[self._blob:]
+            offsets = self._offsets.tolist()
+            words = [blob[offsets[i]:offsets[i + 1]].decode("utf-8")
+                     for i in range(self._counter)]
+            self._words_array = np.array(words + [""], dtype=object)
+        return self._words_array
+
+    def save_binary(self, file):
+        """BinaryVocabで読み込める形式で保存する (ファイルのコピー)"""
+        copyfile(self.file, file + ".tmp")
+        replace(file + ".tmp", file)
+
+    def __getstate__(self):
+        state = {k: v for k, v in self.__dict__.items()
+                 if k not in self._volatile}
+        state["loaded"] = self._word_to_id is not None
+        return state
+
+    def __setstate__(self, state):
+        loaded = state.pop("loaded")
+        self.__dict__.update(state)
+        self._word_to_id = None
+        self._open()
+        if loaded:
+            self.load()
+
+
+def restore_text(data, vocab, skips=None):
     """
     Args:
-        data: (sequence_length) list or ndarray include word id (integer)
+        data: (sequence_length) list, ndarray or tensor include word id (integer)
         vocab:
+        skips: 取り除く ids. <pad> は常に取り除く.
     """
-    skips.append(vocab["<pad>"])
-    # if isinstance(data, list):
-    #     data = np.array(data)
-    #
-    # assert type(data).__module__ == np.__name__
-    # stop_idx = np.where(data == vocab.stop_id)[0]
-    # if len(stop_idx) > 0:
-    #     data = data[:stop_idx[0]]
-    text = " ".join([vocab.id2word(id) for id in data if int(id) not in skips])
-    return text
+    skips = set(skips) if skips else set()
+    skips.add(vocab["<pad>"])
+    return vocab.decode_batch([data], skip_ids=skips)[0]
+
+
+# set in each pool process by _init_counter
+_counter = {}
+
+
+def _init_counter(reader, tokenizer, lower):
+    _counter.update(reader=reader, tokenizer=tokenizer, lower=lower)
+
+
+def _count_tokens(task):
+    start, end = task
+    tokenizer, lower = _counter['tokenizer'], _counter['lower']
+    counts = Counter()
+    for line in _counter['reader'].get_many(range(start, end)):
+        line = line.rstrip("\n")
+        counts.update(tokenizer(line.lower() if lower else line))
+    return counts
+
+
+def build_vocab(data_files, vocab_file, tokenizer=str.split, max_size=0,
+                min_feq=0, lower=False, workers=None, chunk_size=100000):
+    """
+    Count tokens of line files in a process pool and write a vocabulary file
+    readable by Vocab ("<word> <frequency>" lines in frequency order).
+
+    Args:
+        data_files: line file or list of line files.
+        vocab_file: 出力する語彙ファイルまでのpath.
+        tokenizer: function(line) returning the tokens of a line.
+        max_size: Vocabと同じ. special tokensを含めた最大単語数. 0の時は全単語.
+        min_feq: 頻度がmin_feq以下の単語は書き出さない.
+        lower (bool): Trueなら、数える前に小文字化する.
+        workers: number of processes. デフォルトはcpu数.
+        chunk_size: lines counted by a task.
+    Returns:
+        number of words written.
+    """
+    if isinstance(data_files, str):
+        data_files = [data_files]
+    reader = ShardedReader(data_files, workers=workers, advice="sequential")
+    n = len(reader)
+    tasks = [(i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+
+    counts = Counter()
+    with Pool(workers, _init_counter, (reader, tokenizer, lower)) as pool:
+        for c in pool.imap_unordered(_count_tokens, tasks):
+            counts.update(c)
+    reader.close()
+
+    reserved = {PAD_TOKEN, UNKNOWN_TOKEN, SENTENCE_START, SENTENCE_END}
+    words = ((w, c) for w, c in counts.items()
+             if c > min_feq and w not in reserved and w.split() == [w])
+    # ties are ordered by word so the output does not depend on the workers
+    key = lambda wc: (-wc[1], wc[0])  # noqa: E731
+    if max_size != 0:
+        words = heapq.nsmallest(max(max_size - len(reserved), 0), words, key)
+    else:
+        words = sorted(words, key=key)
+
+    with open(vocab_file + ".tmp", "w", encoding="utf-8") as f:
+        for w, c in words:
+            f.write("%s %d\n" % (w, c))
+    replace(vocab_file + ".tmp", vocab_file)
+    return len(words)
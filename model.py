@@ -18,12 +18,15 @@ class Model(object):
         hps: Optional[Dict] = None,
         metric: Optional[str] = None,
         cont: bool = False,
+        async_save: bool = False,
+        single_file: bool = False,
     ) -> None:
         super(Model, self).__init__()
 
         self.model = model
         self.name = name
         self.opts = opts
+        self.states: Dict[str, Any] = {}
         self.metric = metric
 
         if log_root is None:
@@ -55,7 +58,12 @@ class Model(object):
             ckpt_dir = path.join(self.log_dir, "train")
             keep_all = metric is None
             self.saver = MutliParamSaver(
-                ckpt_dir, cont=cont, metric=metric, keep_all=keep_all
+                ckpt_dir,
+                cont=cont,
+                metric=metric,
+                keep_all=keep_all,
+                async_save=async_save,
+                single_file=single_file,
             )
             self.saver.add_param("model", model)
 
@@ -75,6 +83,8 @@ class Model(object):
         for key, val in params.items():
             if key in self.opts:
                 self.opts[key].load_state_dict(val)
+            elif key in self.states:
+                self.states[key].load_state_dict(val)
         return step, dir
 
     def save(self, step: int, loss: float) -> None:
@@ -94,6 +104,11 @@ class Model(object):
         self.opts[key] = opt
         self.saver.add_param(key, opt)
 
+    def add_state(self, key: str, obj: Any) -> None:
+        """save and restore obj (with state_dict/load_state_dict) with the model"""
+        self.states[key] = obj
+        self.saver.add_param(key, obj)
+
     @property
     def device(self) -> torch.device:
         # 全てのパラメータが同一メモリにあると仮定している
@@ -1,8 +1,12 @@
 import torch
-from os import path, makedirs, rename, remove
+from os import path, makedirs, rename, remove, replace
+import atexit
+import copy
 import itertools
 import glob
+import json
 import re
+import threading
 from .logger import get_logger, INFO
 from shutil import rmtree
 
@@ -13,6 +17,34 @@ logger = get_logger(__name__, INFO)
 ckpt_t = Tuple[Optional[str], Optional[int], Optional[float]]
 
 
+def load_file(file: str) -> Any:
+    """torch.load with mmap: tensors are read from the file when they are used"""
+    try:
+        return torch.load(file, mmap=True, map_location="cpu")
+    except (TypeError, RuntimeError):
+        # old torch without mmap or files in the legacy (non zip) format
+        return torch.load(file, map_location="cpu")
+
+
+def snapshot(obj: Any) -> Any:
+    """copy a state_dict to cpu memory so that training can go on modifying it"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        # a shallow copy keeps the type, default_factory and _metadata
+        out = copy.copy(obj)
+        for k, v in obj.items():
+            out[k] = snapshot(v)
+        if hasattr(obj, "_metadata"):
+            out._metadata = copy.deepcopy(obj._metadata)
+        return out
+    if isinstance(obj, tuple) and hasattr(obj, "_fields"):
+        return type(obj)(*(snapshot(v) for v in obj))
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
 class MutliParamSaver(object):
     def __init__(
         self,
@@ -20,7 +52,17 @@ class MutliParamSaver(object):
         cont: bool = False,
         metric: Optional[str] = "lower",
         keep_all: bool = True,
+        async_save: bool = False,
+        single_file: bool = False,
     ) -> None:
+        """
+        Args:
+            single_file (bool): Trueなら、全てのstate_dictを一つの
+                `step-*_score-*.ckpt` ファイルに保存する.
+            async_save (bool): Trueなら、state_dictをcpuにコピーした後、
+                ファイルへの書き込みをbackground threadで行う.
+                次のsave, load_ckpt, wait, 終了時に書き込みを待つ.
+        """
         assert metric == "lower" or metric == "higher" or metric is None, metric
         if metric is None:
             assert keep_all
@@ -29,22 +71,77 @@ class MutliParamSaver(object):
         self.metric = metric
         self.keep_all = keep_all
         self.format = "step-%d_score-%.3f"
+        self.async_save = async_save
+        self.single_file = single_file
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        if async_save:
+            atexit.register(self.wait)
+        self.manifest_file = path.join(log_dir, "manifest.json")
+        self._entries: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
 
         if cont:
-            if path.isdir(self._log_dir):
-                return
-            else:
+            if not path.isdir(self._log_dir):
                 raise ValueError("No dir to continue: %s" % self._log_dir)
         else:
             if path.isdir(self._log_dir):
                 raise ValueError("log directory already exist: %s" % self._log_dir)
+            makedirs(self._log_dir)
 
-        makedirs(self._log_dir)
+        if path.isfile(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self._entries = json.load(f)["ckpts"]
+        else:
+            self.rebuild_manifest()
+
+    def _set_entries(self, entries: List[Dict[str, Any]]) -> None:
+        """write the manifest, then use entries (unchanged if writing fails)"""
+        tmp = self.manifest_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"ckpts": entries}, f, indent=1)
+        replace(tmp, self.manifest_file)
+        self._entries = entries
+
+    def _entry(self, dir: str, step: int, score: Union[int, float]) -> Dict[str, Any]:
+        if path.isfile(dir):
+            sizes = {"file": path.getsize(dir)}
+        else:
+            sizes = {
+                path.basename(f).replace(".ckpt", ""): path.getsize(f)
+                for f in glob.glob(path.join(dir, "*"))
+            }
+        return {
+            "step": int(step),
+            "score": float(score),
+            "path": path.basename(dir),
+            "sizes": sizes,
+        }
+
+    def rebuild_manifest(self) -> None:
+        """manifest.jsonをディレクトリ名から作り直す (scoreは%.3fの精度になる)"""
+        entries = [self._entry(*ckpt) for ckpt in self.scan_ckpts()]
+        with self._lock:
+            self._set_entries(sorted(entries, key=lambda e: e["step"]))
 
     def rm_ckpt(self, dir: str) -> None:
-        rmtree(dir, ignore_errors=True)
+        if path.isfile(dir):
+            remove(dir)
+        else:
+            rmtree(dir, ignore_errors=True)
+        name = path.basename(path.normpath(dir))
+        with self._lock:
+            self._set_entries([e for e in self._entries if e["path"] != name])
 
     def ckpt_list(self) -> List[ckpt_t]:
+        with self._lock:
+            return [
+                (path.join(self._log_dir, e["path"]), e["step"], e["score"])
+                for e in self._entries
+            ]
+
+    def scan_ckpts(self) -> List[ckpt_t]:
+        """checkpointのディレクトリを探す. ckpt_listはmanifestを使う"""
         ckpts = glob.glob(path.join(self._log_dir, "*"))
         # TODO: support format
         reg = re.compile(r".*step-([0-9]+)_score-([0-9]+.[0-9]+).*")
@@ -84,32 +181,92 @@ class MutliParamSaver(object):
                 return ckpt
         return None, None, None
 
+    def wait(self) -> None:
+        """wait for the checkpoint being written and raise its error if any"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(
+        self,
+        dir: str,
+        step: int,
+        score: Union[int, float],
+        states: Dict[str, Any],
+        removes: List[str],
+    ) -> None:
+        try:
+            # written under a name not matching the checkpoint names and
+            # renamed at the end, so a crash never leaves a partial checkpoint
+            tmp = path.join(self._log_dir, "writing-%d.tmp" % step)
+            self.rm_ckpt(tmp)
+            if self.single_file:
+                torch.save(states, tmp)
+            else:
+                makedirs(tmp)
+                for key, state in states.items():
+                    torch.save(state, path.join(tmp, key + ".ckpt"))
+            replace(tmp, dir)
+            entry = self._entry(dir, step, score)
+            with self._lock:
+                self._set_entries(self._entries + [entry])
+            # remove old checkpoints only after the new one is written
+            for d in removes:
+                self.rm_ckpt(d)
+        except BaseException as e:
+            self._error = e
+
     def save(self, step: int, score: Union[int, float]) -> None:
+        # back-pressure: only one checkpoint is written at a time
+        self.wait()
+        # np.float32, 0-dim tensors, ...
+        score = float(score)
         best_dir, best_step, best_score = self.best(self.metric)
         latest_dir, latest_step, _ = self.latest()
 
         assert latest_step != step, step
 
         dir = path.join(self._log_dir, self.format % (step, score))
+        if self.single_file:
+            dir += ".ckpt"
 
-        if path.isdir(dir):
+        if path.exists(dir):
             logger.error("log dir for step %d exisit" % step)
             return
 
-        makedirs(dir)
-
-        for key, val in self.params.items():
-            file_path = path.join(dir, key + ".ckpt")
-            torch.save(val.state_dict(), file_path)
-
+        removes = []
         if not self.keep_all and best_score is not None:
             sign = 1 if self.metric == "higher" else -1
             if (score - best_score) * sign > 0 and best_dir is not None:
-                self.rm_ckpt(best_dir)
+                removes.append(best_dir)
             if best_step != latest_step and latest_dir is not None:
-                self.rm_ckpt(latest_dir)
+                removes.append(latest_dir)
 
-    def load_ckpt(self, method) -> Tuple[Dict[str, Any], int, str]:
+        if not self.async_save:
+            states = {key: val.state_dict() for key, val in self.params.items()}
+            self._write(dir, step, score, states, removes)
+            self.wait()
+            return
+
+        states = {key: snapshot(val.state_dict()) for key, val in self.params.items()}
+        self._thread = threading.Thread(
+            target=self._write,
+            args=(dir, step, score, states, removes),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def load_ckpt(
+        self, method, keys: Optional[List[str]] = None
+    ) -> Tuple[Dict[str, Any], int, str]:
+        """
+        Args:
+            keys: 読み込むkey. Noneなら全て.
+        """
+        self.wait()
         if method == "highest" or method == "lowest":
             # assert self.metric == method
             dir, step, score = self.best(method.replace("est", "er"))
@@ -123,13 +280,18 @@ class MutliParamSaver(object):
         assert score is not None
         assert isinstance(dir, str)
 
+        if path.isfile(dir):
+            ckpt = load_file(dir)
+            params = {k: v for k, v in ckpt.items() if keys is None or k in keys}
+            return params, step, dir
+
         ckpts = glob.glob(path.join(dir, "*"))
 
         params = {}
         for ckpt in ckpts:
-            p = torch.load(ckpt)
             key = path.basename(ckpt).replace(".ckpt", "")
-            params[key] = p
+            if keys is None or key in keys:
+                params[key] = load_file(ckpt)
 
         return params, step, dir
 
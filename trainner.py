@@ -1,16 +1,50 @@
 from .misc import OneLinePrint
 import time
 import math
+import random
+import warnings
 
-from typing import Dict, Union, Any
+from typing import Dict, Union, Any, Optional, Tuple
 from .model import Model
+import numpy as np
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
 
 
 val_t = Union[int, float]
 
 
+def get_rng_state() -> Dict[str, Any]:
+    """Return the states of python, numpy and torch RNGs"""
+    name, keys, pos, has_gauss, gauss = np.random.get_state()
+    state = {
+        "python": random.getstate(),
+        "numpy": (name, keys.tolist(), pos, has_gauss, gauss),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: Dict[str, Any]) -> None:
+    random.setstate(state["python"])
+    name, keys, pos, has_gauss, gauss = state["numpy"]
+    np.random.set_state((name, np.asarray(keys, dtype=np.uint32), pos, has_gauss, gauss))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def resumable_sampler(ld: DataLoader) -> Tuple[Optional[Sampler], int]:
+    """Return (sampler supporting skip, samples per batch) of ld or (None, 0)"""
+    if ld.batch_sampler is not None and hasattr(ld.batch_sampler, "skip"):
+        return ld.batch_sampler, 1
+    if hasattr(ld.sampler, "skip") and ld.batch_size:
+        return ld.sampler, ld.batch_size
+    return None, 0
+
+
 class Context(object):
     def __init__(self) -> None:
         self.epoch = 0
@@ -32,6 +66,20 @@ class Runner(object):
         self.model = model
         self.summary_prefix = summary_prefix
 
+        # position of the next training step
+        self.next_epoch = 0
+        self.next_step_in_epoch = 0
+        # loader passes and batches fetched in the current pass
+        self.ld_epoch = 0
+        self.ld_pos = 0
+        # torch RNG state just before iter(ld) of the current pass
+        self.ld_rng: Optional[torch.Tensor] = None
+        # (ld_epoch, ld_pos) after the last finished training step
+        self.ld_done = (0, 0)
+        # ld_rng of the pass to resume inside
+        self._resume_ld_rng: Optional[torch.Tensor] = None
+        self._resume: Optional[Dict[str, Any]] = None
+
     def write_summary(self, step: int) -> None:
         for key, val in self.ctx.scalar.items():
             key = f"{self.summary_prefix}/{key}"
@@ -43,8 +91,70 @@ class Runner(object):
 
     def batch_gen(self, ld):
         while True:
-            for batch in ld:
+            sampler, unit = resumable_sampler(ld)
+            if sampler is not None:
+                if hasattr(sampler, "set_epoch"):
+                    sampler.set_epoch(self.ld_epoch)
+                sampler.skip(self.ld_pos * unit)
+            resume_rng, self._resume_ld_rng = self._resume_ld_rng, None
+            if self.ld_pos > 0 and resume_rng is not None:
+                # iter(ld) and the first batch draw the worker seeds and the
+                # order of RandomSampler from the torch RNG; draw them as in
+                # the interrupted pass, then go back to the step-time state
+                step_rng = torch.get_rng_state()
+                torch.set_rng_state(resume_rng)
+            else:
+                step_rng = None
+                if self.ld_pos > 0 and sampler is None:
+                    warnings.warn(
+                        "no loader RNG state to resume with: a shuffling "
+                        "sampler without skip() does not resume exactly"
+                    )
+            self.ld_rng = torch.get_rng_state()
+            it = iter(ld)
+            if sampler is None:
+                # the sampler cannot skip: read and discard consumed batches
+                for _ in range(self.ld_pos):
+                    next(it)
+            if step_rng is not None:
+                torch.set_rng_state(step_rng)
+            for batch in it:
+                self.ld_pos += 1
                 yield batch
+            self.ld_epoch += 1
+            self.ld_pos = 0
+
+    @staticmethod
+    def _next_ld_position(ld_epoch: int, ld_pos: int, ld_len: int) -> Tuple[int, int]:
+        """(ld_epoch, ld_pos) with a finished pass moved to the start of the next"""
+        if ld_pos >= ld_len:
+            return ld_epoch + 1, 0
+        return ld_epoch, ld_pos
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Position in the training data and RNG states. Register the runner to
+        the saver (Model.add_state) to store it with every checkpoint.
+        """
+        return {
+            "epoch": self.next_epoch,
+            "step_in_epoch": self.next_step_in_epoch,
+            "ld_epoch": self.ld_done[0],
+            "ld_pos": self.ld_done[1],
+            "ld_rng": self.ld_rng,
+            "rng": get_rng_state(),
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """The next run() starts from the restored position"""
+        self._resume = state
+
+    def save_checkpoint(self, step: int) -> None:
+        """
+        Called every ckpt_step steps inside an epoch. Subclasses using
+        ckpt_step implement it, e.x. with self.model.save(step, score)
+        """
+        raise NotImplementedError()
 
     def run(
         self,
@@ -56,13 +166,38 @@ class Runner(object):
         save_model: bool = False,
         summary_step: int = 0,
         clear_log_each_step: bool = True,
+        ckpt_step: int = 0,
     ):
+        """
+        If a state was given to load_state_dict, training restarts at the
+        saved step and init_epoch is ignored. Samplers with skip (e.g.
+        ResumableRandomSampler) start at the next unseen batch without
+        reading the consumed ones.
+        ckpt_step (int): call save_checkpoint every ckpt_step steps. requires
+            a subclass implementing save_checkpoint
+        """
+        if ckpt_step > 0 and type(self).save_checkpoint is Runner.save_checkpoint:
+            raise NotImplementedError(
+                f"{type(self).__name__} must implement save_checkpoint to use ckpt_step"
+            )
         epoch_length = (
             min(max_step_each_epoch, len(train_ld))
             if max_step_each_epoch > 0
             else len(train_ld)
         )
 
+        first_step = 0
+        if self._resume is not None:
+            state, self._resume = self._resume, None
+            init_epoch = state["epoch"]
+            first_step = state["step_in_epoch"]
+            self.ld_epoch, self.ld_pos = self._next_ld_position(
+                state["ld_epoch"], state["ld_pos"], len(train_ld)
+            )
+            self.ld_done = (self.ld_epoch, self.ld_pos)
+            self._resume_ld_rng = state.get("ld_rng")
+            set_rng_state(state["rng"])
+
         self.train_batcher = self.batch_gen(train_ld)
 
         for epoch in range(init_epoch, max_epoch):
@@ -71,7 +206,9 @@ class Runner(object):
             self.model.train()
             self.ctx._clear()
             elapsed: float = 0
-            for i in range(epoch_length):
+            first = first_step if epoch == init_epoch else 0
+            step = epoch * epoch_length + first - 1
+            for i in range(first, epoch_length):
                 batch = next(self.train_batcher)
 
                 if clear_log_each_step:
@@ -82,6 +219,11 @@ class Runner(object):
                 # forward and loss
                 loss = self.train_step(batch)
                 elapsed += time.time() - start
+                self.next_epoch, self.next_step_in_epoch = epoch, i + 1
+                # a finished pass resumes at the next one without reading it
+                self.ld_done = self._next_ld_position(
+                    self.ld_epoch, self.ld_pos, len(train_ld)
+                )
 
                 if math.isnan(loss):
                     raise ValueError(f"loss is nan, epoch {epoch}, step {step}")
@@ -90,7 +232,7 @@ class Runner(object):
                     # logging
                     t = elapsed / (
                         min(
-                            i,
+                            i - first,
                             (step % summary_step) if summary_step > 0 else float("inf"),
                         )
                         + 1
@@ -103,10 +245,13 @@ class Runner(object):
 
                 # write summary
                 if summary_step > 0 and (step + 1) % summary_step == 0:
-                    self.ctx.scalar["time"] = elapsed / min(i + 1, summary_step)
+                    self.ctx.scalar["time"] = elapsed / min(i - first + 1, summary_step)
                     elapsed = 0
                     self.write_summary(step)
 
+                if ckpt_step > 0 and (step + 1) % ckpt_step == 0:
+                    self.save_checkpoint(step)
+
             # # clean up summary
             if summary_step > 0 and step % summary_step != 0:
                 self.write_summary(step)
@@ -118,6 +263,7 @@ class Runner(object):
             if summary_step > 0:
                 self.write_summary(epoch)
             print(self.olp._mark, self.log_str())
+            self.next_epoch, self.next_step_in_epoch = epoch + 1, 0
 
             # save model
             if save_model > 0: